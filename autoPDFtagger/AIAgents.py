@@ -1,13 +1,60 @@
+import functools
 import logging
 import re
+import random
+import threading
+import time
+import openai
 from openai import OpenAI
-import pprint
-import tenacity
+import httpx
+from dataclasses import dataclass
 import tiktoken
 from autoPDFtagger.config import config
+from autoPDFtagger import fastjson
 api_key = config['OPENAI-API']['API-Key']
 LANGUAGE = config['DEFAULT']['language']
 
+# The OpenAI-library and its HTTP-client log every request,
+# only show their errors
+logging.getLogger("openai").setLevel(logging.ERROR)
+logging.getLogger("httpx").setLevel(logging.ERROR)
+
+# Loading a tiktoken encoding builds the whole BPE merge table,
+# so every encoding is only loaded once per process
+@functools.lru_cache(maxsize=8)
+def get_encoding(encoding_name="cl100k_base"):
+    return tiktoken.get_encoding(encoding_name)
+
+# One OpenAI client per API-Key, shared by all agents, so that
+# its connection pool (keep-alive, TLS sessions) is reused.
+# The pool keeps enough idle connections for parallel requests.
+HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+HTTP_TIMEOUT = httpx.Timeout(300, connect=10)
+_CLIENT_CACHE = {}
+
+def get_client(api_key):
+    if api_key not in _CLIENT_CACHE:
+        _CLIENT_CACHE[api_key] = OpenAI(
+            api_key=api_key, 
+            http_client=httpx.Client(limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+        )
+    return _CLIENT_CACHE[api_key]
+
+# Retrying failed API-Requests: only temporary errors are retried, 
+# with exponentially growing waiting time (in seconds)
+RETRY_ATTEMPTS = 6
+RETRY_MIN_WAIT = 0.5
+RETRY_MAX_WAIT = 60
+RETRYABLE_ERRORS = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+
+# Tokens added to each message of a request for its role and separators
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Patterns for repairing JSON answers
+TRAILING_COMMA_OBJECT_REGEX = re.compile(r',\s*}')
+TRAILING_COMMA_LIST_REGEX = re.compile(r',\s*]')
+JSON_OBJECT_REGEX = re.compile(r'\{.*\}', re.DOTALL)
+
 class AIAgent:
     def __init__(self): 
         self.log_file = "" # set a filename to enable logging of Communication to seperate file
@@ -17,12 +64,21 @@ class AIAgent:
 
     # Try to repair a corrupt JSON
     def clean_json(self, json_text):
+        # Most answers are valid JSON already
+        stripped = json_text.strip()
+        if stripped.startswith("{") and stripped.endswith("}"):
+            try:
+                fastjson.loads(stripped)
+                return stripped
+            except ValueError:
+                pass
+
         # remove additional commas
-        json_text = re.sub(r',\s*}', '}', json_text)
-        json_text = re.sub(r',\s*]', ']', json_text)
+        json_text = TRAILING_COMMA_OBJECT_REGEX.sub('}', json_text)
+        json_text = TRAILING_COMMA_LIST_REGEX.sub(']', json_text)
 
         # Looking for a JSON-Objekt
-        match = re.search(r'\{.*\}', json_text, re.DOTALL)
+        match = JSON_OBJECT_REGEX.search(json_text)
         if match:
             return match.group(0)
         return None
@@ -37,52 +93,142 @@ class AIAgent:
     
 
 
-OpenAI_model_pricelist = { # $ per 1 k token, [input, output, token_limit]
-    "gpt-3.5-turbo-1106": [0.001, 0.002, 16385],
-    "gpt-4-1106-preview": [0.01, 0.03, 4096], # Max  = 128000, reduced for cost reasons
-    "gpt-4-vision-preview": [0.01, 0.03, 4096]
+# Finds the end of the first JSON object in a text which is 
+# fed in pieces (e.g. chunks of a streamed answer). Braces in 
+# text before the object (e.g. "{name}" in an explanation) 
+# don't count: a closed object must be valid JSON
+class JSONObjectEnd:
+    def __init__(self):
+        self.parts = []
+        self.length = 0 # number of characters fed so far
+        self.start = 0 # position of the opening brace of the current object
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    # Returns the position after the closing brace of the object 
+    # within the whole text fed so far, or None if the object is 
+    # not complete yet
+    def feed(self, piece):
+        offset = self.length
+        self.parts.append(piece)
+        self.length += len(piece)
+        for position, char in enumerate(piece, offset):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = self.depth > 0
+            elif char == "{":
+                if self.depth == 0:
+                    self.start = position
+                self.depth += 1
+            elif char == "}" and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 0:
+                    text = "".join(self.parts)
+                    try:
+                        fastjson.loads(text[self.start:position + 1])
+                        return position + 1
+                    except ValueError:
+                        pass # not JSON, look for the next object
+        return None
+
+
+@dataclass(frozen=True)
+class ModelPrice:
+    input: float # $ per 1 k input token
+    output: float # $ per 1 k output token
+    token_limit: int
+
+OpenAI_model_pricelist = {
+    "gpt-3.5-turbo-1106": ModelPrice(0.001, 0.002, 16385),
+    "gpt-4-1106-preview": ModelPrice(0.01, 0.03, 4096), # Max  = 128000, reduced for cost reasons
+    "gpt-4-vision-preview": ModelPrice(0.01, 0.03, 4096)
 }
 
 class AIAgent_OpenAI(AIAgent):
+    # Number of tokens of each system message, every 
+    # system message only needs to be tokenized once
+    system_token_counts = {}
+
     def __init__(self, 
                  model="gpt-3.5-turbo-1106", 
                  system_message="You are a helpful assistant"):
         super().__init__()
         
         self.api_key = api_key
-        self.client = OpenAI(api_key=self.api_key)
+        self.client = get_client(self.api_key)
         self.set_model(model)
-        self.messages = []
-        self.add_message(system_message, role="system")
+        if system_message not in self.system_token_counts:
+            self.system_token_counts[system_message] = len(get_encoding().encode_ordinary(system_message))
+        self.system_token_count = self.system_token_counts[system_message]
+        self.messages = [{"role": "system", "content": system_message}]
+        # Running number of tokens in self.messages, so that the size of the
+        # conversation is known without tokenizing it again
+        self.token_count = self.system_token_count
 
         # Cost-Control
         self.max_tokens=4096
         self.cost = 0
+        self.cost_lock = threading.Lock() # requests may run in parallel threads
 
 
-    def add_message(self, content, role="user"):
+    # token_count: number of tokens of content if already known 
+    # (e.g. from shortening the text), saves tokenizing it again
+    def add_message(self, content, role="user", token_count=None):
         self.messages.append({"role": role, "content": content})
+        if token_count is not None:
+            self.token_count += token_count
+        elif isinstance(content, str):
+            self.token_count += len(get_encoding().encode_ordinary(content))
 
-    @tenacity.retry(
-            wait=tenacity.wait_random_exponential(min=5, max=60), 
-            stop=tenacity.stop_after_attempt(6))
     def send_request(self,
                     temperature=0.7,
-                    response_format="text" # Alt: "object-json"
+                    response_format="text", # Alt: "object-json"
+                    messages=None, # defaults to the agent's conversation (self.messages)
+                    stream=False, # receive the answer in chunks while it is generated
+                    prompt_tokens=None # number of tokens of messages if known (see count_message_tokens)
                     ):
-        logging.debug("Trying to send API-Request")
-        # Temporäres Ändern des Logging-Levels
-        original_level = logging.getLogger().getEffectiveLevel()
-        logging.getLogger().setLevel(logging.ERROR)  # Ändere das Logging-Level auf ERROR
+        if messages is None:
+            messages = self.messages
 
-        try:
-            encoding = tiktoken.encoding_for_model('gpt-3.5-turbo')
+        wait = RETRY_MIN_WAIT
+        for attempt in range(1, RETRY_ATTEMPTS + 1):
+            try:
+                if stream:
+                    return self.send_request_stream(temperature, response_format, messages, prompt_tokens)
+                return self.send_request_once(temperature, response_format, messages)
+            except RETRYABLE_ERRORS as e:
+                if attempt == RETRY_ATTEMPTS:
+                    raise
+                # Prefer the waiting time requested by the server
+                sleep_time = self.get_retry_after(e) or random.uniform(wait / 2, wait)
+                logging.info("API-Request failed (attempt %d), retrying in %.1f s", attempt, sleep_time)
+                time.sleep(sleep_time)
+                wait = min(wait * 2, RETRY_MAX_WAIT)
 
+    # Read the Retry-After header (in seconds) of a failed request if available
+    def get_retry_after(self, error):
+        response = getattr(error, "response", None)
+        if response is None:
+            return None
+        try:
+            return min(float(response.headers.get("retry-after")), RETRY_MAX_WAIT)
+        except (TypeError, ValueError):
+            return None
 
+    def send_request_once(self, temperature, response_format, messages):
+        logging.debug("Trying to send API-Request")
+        try:
             if response_format:
                 response = self.client.chat.completions.create(
                     model=self.model,
-                    messages=self.messages,
+                    messages=messages,
                     response_format={"type": response_format},
                     temperature=temperature,
                     max_tokens=self.max_tokens
@@ -90,43 +236,156 @@ class AIAgent_OpenAI(AIAgent):
             else:  
                 response = self.client.chat.completions.create(
                     model=self.model,
-                    messages=self.messages,
+                    messages=messages,
                     temperature=temperature,
                     max_tokens=self.max_tokens
                 )   
 
             # Logging Data in seperate file if log_file is set
-            self.write_to_log_file(
-                "API-REQUEST:\n" 
-                + pprint.pformat(self.messages) 
-                + "\n\nAPI-ANSWER:\n" 
-                + pprint.pformat(response))
-
-            self.cost += self.get_costs(response.usage.prompt_tokens, response.usage.completion_tokens)
+            if self.log_file:
+                self.write_to_log_file(
+                    "API-REQUEST:\n" 
+                    + fastjson.dumps(self.strip_images(messages), indent=True) 
+                    + "\n\nAPI-ANSWER:\n" 
+                    + str(response) + "\n\n")
 
-            
-            logging.getLogger().setLevel(original_level)
+            with self.cost_lock:
+                self.cost += self.get_costs(response.usage.prompt_tokens, response.usage.completion_tokens)
 
             return self.clean_json(response.choices[0].message.content)
             
         except Exception as e: 
             logging.error(e)
-            # Restore original logging level
-            logging.getLogger().setLevel(original_level)
             raise e
 
+    # Same as send_request_once, but the answer is streamed and 
+    # assembled from its chunks, so no connection sits idle until 
+    # the whole completion has been generated
+    def send_request_stream(self, temperature, response_format, messages, prompt_tokens=None):
+        logging.debug("Trying to send streaming API-Request")
+        try:
+            arguments = {}
+            if response_format:
+                arguments["response_format"] = {"type": response_format}
+            stream = self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=self.max_tokens,
+                stream=True,
+                # The token usage is sent in an additional last chunk
+                # (not a parameter of create() in openai 1.3.7)
+                extra_body={"stream_options": {"include_usage": True}},
+                **arguments
+            )
+
+            # All answers consist of one JSON object. Reading is stopped when 
+            # text other than whitespace follows the complete object, so that 
+            # no tokens are generated (and paid) for additional explanations 
+            # which are sometimes following
+            chunks = []
+            json_end = JSONObjectEnd()
+            end = None
+            usage = None
+            for chunk in stream:
+                usage = getattr(chunk, "usage", None) or usage
+                if not (chunk.choices and chunk.choices[0].delta.content):
+                    continue
+                content = chunk.choices[0].delta.content
+                chunks.append(content)
+                if end is None:
+                    end = json_end.feed(content)
+                    if end is None:
+                        continue
+                if "".join(chunks)[end:].strip():
+                    stream.response.close()
+                    logging.debug("Complete JSON received, stopped reading the answer")
+                    break
+            answer = "".join(chunks)
+            if end is not None:
+                answer = answer[:end]
+
+            # Logging Data in seperate file if log_file is set
+            if self.log_file:
+                self.write_to_log_file(
+                    "API-REQUEST:\n" 
+                    + fastjson.dumps(self.strip_images(messages), indent=True) 
+                    + "\n\nAPI-ANSWER (streamed):\n" 
+                    + answer + "\n\n")
+
+            if usage is not None:
+                cost = self.get_costs(*self.get_usage_tokens(usage))
+            else:
+                # No usage was received (the answer was cut off before the last 
+                # chunk), so the costs are estimated by counting the tokens 
+                # locally (unless the caller knows them already)
+                if prompt_tokens is None:
+                    prompt_tokens = self.count_message_tokens(messages)
+                cost = self.get_costs(prompt_tokens, len(get_encoding().encode_ordinary(answer)))
+            with self.cost_lock:
+                self.cost += cost
+
+            # Text before the object (e.g. an introduction) is left out
+            if end is not None:
+                answer = answer[json_end.start:]
+            return self.clean_json(answer)
+
+        except Exception as e: 
+            logging.error(e)
+            raise e
+
+    # Prompt and completion tokens of the usage of a streamed answer, 
+    # which openai 1.3.7 doesn't parse (it is left as a dict)
+    def get_usage_tokens(self, usage):
+        if isinstance(usage, dict):
+            return usage["prompt_tokens"], usage["completion_tokens"]
+        return usage.prompt_tokens, usage.completion_tokens
+
+    # Approximate number of prompt tokens of a message list. Images 
+    # are counted with the tokens of a low-detail image (85) or a
+    # typical high-detail image of 1024 pixels (765)
+    def count_message_tokens(self, messages):
+        # The tokens of the agent's own conversation are already counted
+        if messages is self.messages and all(isinstance(message["content"], str) for message in messages):
+            return self.token_count + MESSAGE_OVERHEAD_TOKENS * len(messages)
+
+        encoding = get_encoding()
+        count = 0
+        for message in messages:
+            content = message["content"]
+            if isinstance(content, list):
+                count += sum(
+                    85 if part["image_url"].get("detail") == "low" else 765
+                    for part in content if part.get("type") == "image_url"
+                )
+                content = " ".join(part["text"] for part in content if part.get("type") == "text")
+            count += len(encoding.encode_ordinary(content)) + MESSAGE_OVERHEAD_TOKENS
+        return count
+
+    # Replace base64-encoded images in a message list by a short 
+    # placeholder, used to keep the log file readable and small
+    def strip_images(self, messages):
+        stripped = []
+        for message in messages:
+            content = message["content"]
+            if isinstance(content, list):
+                content = [
+                    {**part, "image_url": {**part["image_url"], 
+                        "url": f"<image omitted, {len(part['image_url']['url'])} bytes>"}}
+                    if part.get("type") == "image_url" else part
+                    for part in content
+                ]
+            stripped.append({**message, "content": content})
+        return stripped
+
     def get_costs(self, token_input, token_output):
-        if self.model in OpenAI_model_pricelist:
-            cost_per_token_input, cost_per_token_output, limit = OpenAI_model_pricelist[self.model]
-            total_cost_input = token_input * cost_per_token_input / 1000
-            total_cost_output = token_output * cost_per_token_output / 1000
-            return total_cost_input + total_cost_output
-        else:
-            raise ValueError("Model '" + self.model + "' not found in the price list.")
+        # Price of the actual model is looked up once in set_model
+        return (token_input * self.price.input + token_output * self.price.output) / 1000
 
     def set_model(self, model):
         if model in OpenAI_model_pricelist:
             self.model = model
+            self.price = OpenAI_model_pricelist[model]
         else:
             raise ValueError("Model '" + model + "' not available.")
     
@@ -5,21 +5,60 @@
 # (see AIAgents.py).
 
 from autoPDFtagger.AIAgents import AIAgent_OpenAI
-from autoPDFtagger.AIAgents import OpenAI_model_pricelist
+from autoPDFtagger.AIAgents import get_encoding, MESSAGE_OVERHEAD_TOKENS
 import logging
 from autoPDFtagger.config import config
 api_key = config['OPENAI-API']['API-Key']
 LANGUAGE = config['DEFAULT']['language']
 
 from autoPDFtagger.PDFDocument import PDFDocument
+from autoPDFtagger import fastjson
 import json
-import pprint
 import re
-import copy
-import tiktoken
+import os
+import hashlib
+import itertools
+import threading
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Maximum number of API-requests running at the same time
+REQUEST_CONCURRENCY = config['OPENAI-API'].getint('concurrency', fallback=4)
+
+# Images are downscaled to this size (long edge, in pixels) before 
+# uploading, GPT-Vision scales larger images down anyway
+IMAGE_MAX_SIZE = 1024
+
+# Number of scanned pages sent to GPT-Vision in one request
+PAGE_BATCH_SIZE = config['OPENAI-API'].getint('page_batch_size', fallback=1)
+
+# Scanned pages with at least this number of recognized words 
+# are left to the text analysis
+PAGE_MAX_WORDS = 100
+
+# Meaningful words: at least 3 word characters
+WORD_REGEX = re.compile(r'\w{3,}')
+
+# The answer of the tag analysis is only reevaluated in a 
+# second request if it contains at least this number of replacements
+TAG_REEVALUATION_THRESHOLD = 3
+
+# Maximum number of image analysis answers kept in memory
+IMAGE_RESPONSE_CACHE_SIZE = 1024
+
+# Maximum number of tag replacements kept from previous runs (0 disables the cache)
+TAG_CACHE_SIZE = config['OPENAI-API'].getint('tag_cache_size', fallback=1000)
+
+# Tag replacements of previous runs, stored by a hash of the tag list
+TAG_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cache", "autoPDFtagger", "tag_cache.json")
 
 # IMAGE-Analysis
 class AIAgent_OpenAI_pdf_image_analysis(AIAgent_OpenAI):
+    # Answers of image requests by a hash of the request, shared
+    # by all agents (requests may run in parallel threads)
+    image_response_cache = {}
+    image_response_lock = threading.Lock()
+
     def __init__(self):
         system_message = f"""
         You are a helpful assistant analyzing images inside of documents. 
@@ -48,7 +87,7 @@ class AIAgent_OpenAI_pdf_image_analysis(AIAgent_OpenAI):
         pdf_document.analyze_document_images()
 
         # Prevent modifying the original document
-        working_doc = copy.deepcopy(pdf_document)
+        working_doc = pdf_document.clone_metadata()
         
         # For the general requirement of this function, 
         # I have different approaches, which vary depending 
@@ -87,112 +126,187 @@ class AIAgent_OpenAI_pdf_image_analysis(AIAgent_OpenAI):
         return working_doc.to_api_json()
 
     # A generic function to ask GPT to analyze a list of Images (list_imgaes_base64)
-    # in context of information of a PDFDocument (document)
+    # in context of information of a PDFDocument (document_json, 
+    # see PDFDocument.to_api_json). The document is passed as a JSON 
+    # snapshot, as requests run in worker threads while the document 
+    # is updated with the answers in the main thread.
     # The decision regarding the selection of images and their 
     # extraction from the document is made separately, therefore 
     # these must be passed as additional parameters.
-    def send_image_request(self, document: PDFDocument, list_images_base64):
-        logging.info("Asking GPT-Vision for analysis of " + str(len(list_images_base64)) + " Images found in " + document.get_absolute_path())
-        
+    # detail ("low", "high" or "auto") controls how finely GPT-Vision 
+    # tiles the images, "low" costs a fixed small number of tokens.
+    def send_image_request(self, document_json, list_images_base64, detail="auto"):
         user_message = (
             "Analyze following Images which are found in a document. "
             "Please extend the existing information by keeping their JSON-Format: "
-            + document.to_api_json() + 
+            + document_json + 
             " Try to imagine as many valuable keywords and categories as possible. "
             "Imagine additional keywords thinking of a wider context and possible categories in an archive system. "
             "Answer in JSON-Format corresponding to given input."
         )
 
+        # Text followed by the individual images
         message_content = [
         {
             "type": "text",
             "text": user_message
         }]
-
-        # Add individual images to the message
-        for base64_image in list_images_base64:
-            image_content = {
+        message_content.extend(
+            {
                 "type": "image_url",
                 "image_url": {
-                    "url": f"data:image/png;base64,{base64_image}"
+                    "url": "data:image/jpeg;base64," + base64_image,
+                    "detail": detail
                 }
             }
-            message_content.append(image_content)
+            for base64_image in list_images_base64
+        )
 
-        self.add_message(message_content)
+        # Every image request is sent as a separate conversation
+        # (system message + images), so that several requests
+        # can run in parallel without sharing self.messages
+        messages = self.messages + [{"role": "user", "content": message_content}]
 
+        # Same images with the same question asked before in this session?
+        cache_key = self.get_image_cache_key(user_message, list_images_base64, detail)
+        with self.image_response_lock:
+            if cache_key in self.image_response_cache:
+                logging.info("Using cached answer for image analysis")
+                return self.image_response_cache[cache_key]
 
         try:
-            response = super().send_request(temperature=0.2, response_format = None, )
-            return response
+            response = super().send_request(temperature=0.2, response_format = None, messages=messages, stream=True)
         except Exception as e:
             logging.error("API-Call failed")
             logging.error(e)
             return None
 
-    def process_images_by_size(self, pdf_document: PDFDocument):
-        # Create a list of all images from each page
-        all_images = [image for page in pdf_document.images for image in page]
-        # Sort images by pixel count (width x height)
-        sorted_images = sorted(all_images, key=lambda img: img["original_width"] * img["original_height"], reverse=True)
+        if response:
+            with self.image_response_lock:
+                # Forget the oldest answer if the cache is full
+                if len(self.image_response_cache) >= IMAGE_RESPONSE_CACHE_SIZE:
+                    del self.image_response_cache[next(iter(self.image_response_cache))]
+                self.image_response_cache[cache_key] = response
+        return response
+
+    # The key covers everything the answer depends on: model, 
+    # system message, question (including the document data) and images
+    def get_image_cache_key(self, user_message, list_images_base64, detail):
+        key = hashlib.blake2b(digest_size=16)
+        for part in [self.model, self.messages[0]["content"], user_message, detail, *list_images_base64]:
+            key.update(part.encode())
+            key.update(b"\0")
+        return key.hexdigest()
 
+    def process_images_by_size(self, pdf_document: PDFDocument):
+        # Compute the pixel count (width x height) of all images from each page once
+        image_areas = [
+            (image["original_width"] * image["original_height"], image)
+            for page in pdf_document.images for image in page
+        ]
         # Filter out images smaller than 90000 pixels (e.g., less than 300x300)
-        relevant_images = [img for img in sorted_images if img["original_width"] * img["original_height"] >= 90000]
+        # before sorting the remaining images by pixel count
+        image_areas = [entry for entry in image_areas if entry[0] >= 90000]
+        image_areas.sort(key=itemgetter(0), reverse=True)
+        relevant_images = [image for area, image in image_areas]
 
         # Process images in groups of 3
-        for i in range(0, len(relevant_images), 3):
-            group = relevant_images[i:i + 3]
-            base64_group = []
-
-            for image in group:
-                base64_group.append(pdf_document.get_png_image_base64_by_xref(image['xref']))
-
-            # Call ai_analyze_images with the group of images
-            response = self.send_image_request(pdf_document, base64_group)
-            try:
-                pdf_document.set_from_json(response)
-            except Exception as e:
-                logging.error("API-Call for image analysis failed")
-                logging.error(e)
-
-            if pdf_document.has_sufficient_information():
-                logging.info("Document information sufficient. Proceeding with next document.")
-                return pdf_document
-            else:
-                logging.info("Still lacking information, looking for more images")
+        xref_groups = (
+            [image['xref'] for image in relevant_images[i:i + 3]] 
+            for i in range(0, len(relevant_images), 3)
+        )
+        pdf_document = self.process_image_groups(pdf_document, xref_groups)
         logging.info("No more images found.")
         return pdf_document
             
     def process_images_by_page(self, pdf_document: PDFDocument):
-        for page in pdf_document.pages:
-            logging.debug(f"Checking Page {page['page_number']} looking for largest image")
-            # Skip page if no images are present
-            if 'max_img_xref' not in page or not page['max_img_xref']:
-                logging.debug("Page not analyzed: (no images)")
-                continue
-
-            # Get the largest image of the site (assuming it to be the scan-image)
-            image_base64 = pdf_document.get_png_image_base64_by_xref(page['max_img_xref'])
-
-            # Send it to GPT
-            logging.info("Asking AI for analyzing scanned page")
-            response = self.send_image_request(pdf_document, [image_base64])
-          
-            try:
-                pdf_document.set_from_json(response)
-            except Exception as e:
-                logging.error("API-Call for image analysis failed")
-                logging.error(e)
-
-            # Only proceed if the information about the document is still insufficient
-            if pdf_document.has_sufficient_information():
-                logging.info("Document information sufficient, proceeding.")
-                return pdf_document
-            else:
-                logging.info("Still lacking information, looking for more pages")
+        # Get the largest image of each page (assuming it to be the scan-image)
+        def page_xrefs():
+            for index, page in enumerate(pdf_document.pages):
+                logging.debug("Checking Page %s looking for largest image", page['page_number'])
+                # Skip page if no images are present
+                if 'max_img_xref' not in page or not page['max_img_xref']:
+                    logging.debug("Page not analyzed: (no images)")
+                    continue
+                # Pages with enough recognized text are covered by the 
+                # text analysis, only the first page is always analyzed
+                if index > 0 and page.get('words_count', 0) >= PAGE_MAX_WORDS:
+                    logging.debug("Page not analyzed: (enough text)")
+                    continue
+                yield page['max_img_xref']
+
+        # Send PAGE_BATCH_SIZE pages per request
+        xrefs = page_xrefs()
+        xref_groups = iter(lambda: list(itertools.islice(xrefs, PAGE_BATCH_SIZE)), [])
+        # Scanned pages are looked at in low detail first. If the
+        # information is still insufficient, the first page (where most 
+        # of the relevant information is expected) is analyzed in high detail.
+        pdf_document = self.process_image_groups(pdf_document, xref_groups, detail="low")
+        if not pdf_document.has_sufficient_information():
+            first_xref = next(page_xrefs(), None)
+            if first_xref:
+                logging.info("Analyzing first page in high detail")
+                pdf_document = self.process_image_groups(pdf_document, [[first_xref]], detail="high")
         logging.info("No more pages available.")
         return pdf_document
 
+    # Send groups of images (given by lists of xrefs) to GPT-Vision 
+    # and merge the answers into pdf_document, until all groups are 
+    # analyzed or the information about the document is sufficient.
+    # Groups are sent in parallel (at most REQUEST_CONCURRENCY at a time)
+    # and the answers are merged as they arrive. The next group is extracted
+    # while the running requests are waiting for their answers. 
+    # As soon as the information is sufficient, no more groups are 
+    # sent. Requests already running are waited for (they are paid
+    # anyway and their costs need to be counted) and merged, too.
+    def process_image_groups(self, pdf_document: PDFDocument, xref_groups, detail="auto"):
+        xref_groups = iter(xref_groups)
+
+        # Extract images in the main thread, PyMuPDF is not thread-safe
+        def extract_next_group():
+            group = next(xref_groups, None)
+            if group is None:
+                return None
+            return pdf_document.get_jpeg_images_base64_by_xrefs(group, max_size=IMAGE_MAX_SIZE)
+
+        def merge_answers(futures):
+            for future in futures:
+                try:
+                    pdf_document.set_from_json(future.result())
+                except Exception as e:
+                    logging.error("API-Call for image analysis failed")
+                    logging.error(e)
+
+        running = set()
+        with ThreadPoolExecutor(max_workers=REQUEST_CONCURRENCY) as executor:
+            next_group = extract_next_group()
+            while True:
+                while next_group is not None and len(running) < REQUEST_CONCURRENCY:
+                    # The snapshot of the document is taken here in the main 
+                    # thread, the worker only gets strings
+                    if logging.getLogger().isEnabledFor(logging.INFO):
+                        logging.info("Asking GPT-Vision for analysis of %d Images found in %s", len(next_group), pdf_document.get_absolute_path())
+                    running.add(executor.submit(self.send_image_request, pdf_document.to_api_json(), next_group, detail))
+                    next_group = extract_next_group()
+                if not running:
+                    break
+
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                merge_answers(done)
+
+                if pdf_document.has_sufficient_information():
+                    logging.info("Document information sufficient. Proceeding with next document.")
+                    break
+                else:
+                    logging.info("Still lacking information, looking for more images")
+
+            # Wait for the requests which are still running 
+            # before leaving (closing the executor waits, too)
+            if running:
+                logging.info("Waiting for %d running requests", len(running))
+                merge_answers(wait(running).done)
+        return pdf_document
+
 # TEXT-Analysis
 class AIAgent_OpenAI_pdf_text_analysis(AIAgent_OpenAI):
     def __init__(self):
@@ -244,41 +358,25 @@ class AIAgent_OpenAI_pdf_text_analysis(AIAgent_OpenAI):
         # to decide which model to use
         # GPT-3.5 is good enough for long texts and much cheaper. 
         # Especially in shorter texts, GPT-4 gives much more high-quality answers
-        word_count = len([word for word in re.split(r'\W+', pdf_document.get_pdf_text()) if len(word) >= 3])
-        model_choice = "gpt-3.5-turbo-1106" if word_count > 100 else "gpt-4-1106-preview"
+        model_choice = "gpt-4-1106-preview" if self.is_short_text(pdf_document) else "gpt-3.5-turbo-1106"
         #model_choice = "gpt-4-1106-preview" # for test purposes
 
-        logging.debug("Opting for " + model_choice)
+        logging.debug("Opting for %s", model_choice)
         self.set_model(model_choice)
         
-        message = ("Analyze following OCR-Output. Try to imagine as many valuable keywords and categories as possible. "
+        prompt = ("Analyze following OCR-Output. Try to imagine as many valuable keywords and categories as possible. "
             "Imagine additional keywords thinking of a wider context and possible categories in an archive system. "
             f"Use {LANGUAGE} Language. Answer in the given pattern (JSON): "
-            + pdf_document.get_short_description()
         )
         
         # in case of very long text, we have to shorten it depending on 
         # the specific token-limit of the actual model
+        text, token_count = self.shorten_to_token_limit(prompt, pdf_document.get_short_description())
 
-        # Optimize request data
-        # Convert message-list to str
-        request_test_str = pprint.pformat(self.messages)
-        # estimate token-number for request
-        num_tokens = num_tokens_from_string(request_test_str)
-        # estimate 500 Tokens for answer
-        tokens_required = num_tokens + 500
-        
-        # max tokens of the actual model stored in price list table
-        diff_to_max =  tokens_required - OpenAI_model_pricelist[self.model][2]
-        if diff_to_max > 0: # message too long 
-            # we need to shorten it
-            # estimating 3 characters per Token
-            message = message[:-(diff_to_max*3)] 
-            logging.info("PDF-Text needs to be shortened due to token_limit by " + str(diff_to_max*3) + " characters.")
-
-        self.add_message(message, role="user")
+        # The tokens are already counted while shortening
+        self.add_message(prompt + text, role="user", token_count=token_count)
     
-        primary_response = super().send_request(temperature=0.7, response_format = self.response_format)
+        primary_response = super().send_request(temperature=0.7, response_format = self.response_format, stream=True)
         return primary_response
  
         # At this point, a secondary request could be implemented to 
@@ -303,6 +401,136 @@ class AIAgent_OpenAI_pdf_text_analysis(AIAgent_OpenAI):
         
         #return secondary_response
 
+    # Documents with less than 100 meaningful words are considered short
+    def is_short_text(self, pdf_document: PDFDocument):
+        # Stop counting as soon as the limit is exceeded
+        words = WORD_REGEX.finditer(pdf_document.get_pdf_text())
+        word_count = sum(1 for _ in itertools.islice(words, 101))
+        return word_count <= 100
+
+    # Shorten text so that a request consisting of the conversation so far, 
+    # prompt and text fits into the token-limit of the actual model.
+    # reserved_tokens are kept free for the answer. 
+    # Returns the text and the number of tokens of prompt and text
+    def shorten_to_token_limit(self, prompt, text, reserved_tokens=500):
+        # Tokenize the prompt and the text only once, the size of the
+        # conversation so far is counted in add_message. encode_ordinary skips 
+        # the search for special tokens, which are not expected in OCR text anyway
+        encoding = get_encoding()
+        prompt_tokens = len(encoding.encode_ordinary(prompt))
+        fixed_tokens = self.token_count + prompt_tokens
+        text_tokens = encoding.encode_ordinary(text)
+        
+        # max tokens of the actual model stored in price list table
+        tokens_available = self.price.token_limit - fixed_tokens - reserved_tokens
+        if len(text_tokens) <= tokens_available:
+            return text, prompt_tokens + len(text_tokens)
+
+        # message too long, cutting the token list at the limit
+        text_tokens = text_tokens[:max(tokens_available, 0)]
+        logging.info("PDF-Text needs to be shortened due to token_limit to %d tokens.", len(text_tokens))
+        return encoding.decode(text_tokens), prompt_tokens + len(text_tokens)
+
+    # Analyze several documents with short texts in one single request
+    # to save API-calls. Returns a list of json-strings in the order 
+    # of pdf_documents (None for documents without answer).
+    # If the documents don't fit into the token-limit, they are 
+    # split into several requests. If a request fails (no answer or 
+    # not one result per document), its documents are analyzed separately.
+    def analyze_text_batch(self, pdf_documents):
+        self.set_model("gpt-4-1106-preview")
+
+        # Tokenize all descriptions at once (in parallel threads of tiktoken)
+        # and fill each request with as many documents as fit into the token-limit,
+        # keeping 500 tokens for each answer (and some for prompt and numbering)
+        descriptions = [pdf_document.get_short_description() for pdf_document in pdf_documents]
+        description_tokens = get_encoding().encode_ordinary_batch(descriptions)
+        tokens_available = self.price.token_limit - self.token_count - 150
+
+        results = []
+        start = 0
+        while start < len(pdf_documents):
+            end = start
+            used_tokens = 0
+            while end < len(pdf_documents) and (end == start or used_tokens + len(description_tokens[end]) + 510 <= tokens_available):
+                used_tokens += len(description_tokens[end]) + 510
+                end += 1
+            batch_results = self.send_text_batch(pdf_documents[start:end], description_tokens[start:end])
+            if batch_results is None:
+                logging.info("Analyzing the documents of the failed batch separately")
+                batch_results = self.analyze_text_separately(pdf_documents[start:end])
+            results += batch_results
+            start = end
+        return results
+
+    # Fallback for analyze_text_batch: one request per document, 
+    # each in its own conversation. Costs are added to this agent.
+    def analyze_text_separately(self, pdf_documents):
+        results = []
+        for pdf_document in pdf_documents:
+            ai = AIAgent_OpenAI_pdf_text_analysis()
+            ai.log_file = self.log_file
+            try:
+                results.append(ai.analyze_text(pdf_document))
+            except Exception as e:
+                logging.error("Text analysis of %s failed: %s", pdf_document.file_name, e)
+                results.append(None)
+            with self.cost_lock:
+                self.cost += ai.cost
+        return results
+
+    # Shorten the (tokenized) descriptions of a batch so that the request fits 
+    # into the token-limit. Every document keeps its own share of the 
+    # available tokens: short descriptions are kept completely, the rest 
+    # is split evenly among the longer ones, so no document is cut out.
+    # Returns the numbered descriptions as text and their number of tokens
+    def shorten_descriptions(self, prompt, description_tokens, reserved_tokens):
+        encoding = get_encoding()
+        labels = [("\n\n" if i > 1 else "") + f"[DOC {i}] " for i in range(1, len(description_tokens) + 1)]
+        label_tokens = sum(len(tokens) for tokens in encoding.encode_ordinary_batch(labels))
+        prompt_tokens = len(encoding.encode_ordinary(prompt))
+        tokens_available = (self.price.token_limit - self.token_count - prompt_tokens 
+                            - label_tokens - reserved_tokens)
+
+        budgets = [0] * len(description_tokens)
+        remaining = max(tokens_available, 0)
+        by_length = sorted(range(len(description_tokens)), key=lambda i: len(description_tokens[i]))
+        for position, index in enumerate(by_length):
+            budgets[index] = min(len(description_tokens[index]), remaining // (len(by_length) - position))
+            remaining -= budgets[index]
+
+        parts = []
+        for label, tokens, budget in zip(labels, description_tokens, budgets):
+            if budget < len(tokens):
+                logging.info("PDF-Text needs to be shortened due to token_limit to %d tokens.", budget)
+            parts.append(label + encoding.decode(tokens[:budget]))
+        return "".join(parts), prompt_tokens + label_tokens + sum(budgets)
+
+    # Send one request for analyze_text_batch, returns None if the 
+    # answer is missing or doesn't contain one result per document
+    def send_text_batch(self, pdf_documents, description_tokens):
+        prompt = ("Analyze the following OCR-Outputs of " + str(len(pdf_documents)) + " different documents "
+            "separately. Try to imagine as many valuable keywords and categories as possible. "
+            "Imagine additional keywords thinking of a wider context and possible categories in an archive system. "
+            f"Use {LANGUAGE} Language. Answer in JSON with a list containing one result "
+            "in the given pattern for each document in the same order: "
+            '{"results": [{...}, {...}]}\n'
+        )
+        descriptions, token_count = self.shorten_descriptions(prompt, description_tokens, 500 * len(pdf_documents))
+
+        messages = self.messages + [{"role": "user", "content": prompt + descriptions}]
+        try:
+            response = super().send_request(temperature=0.7, response_format=self.response_format, messages=messages, stream=True,
+                prompt_tokens=self.token_count + token_count + MESSAGE_OVERHEAD_TOKENS * len(messages))
+            results = fastjson.loads(response)['results']
+        except Exception as e:
+            logging.error("Could not interpret AI answer for batch text analysis: " + str(e))
+            return None
+        if not isinstance(results, list) or len(results) != len(pdf_documents):
+            logging.error(f"Batch text analysis returned {len(results) if isinstance(results, list) else 'no list of'} results for {len(pdf_documents)} documents")
+            return None
+        return [fastjson.dumps(result) for result in results]
+
 
 # TAG/KEYWORD-Analysis
 class AIAgent_OpenAI_pdf_tag_analysis(AIAgent_OpenAI):
@@ -326,14 +554,50 @@ class AIAgent_OpenAI_pdf_tag_analysis(AIAgent_OpenAI):
         super().__init__(model="gpt-4-1106-preview", system_message=system_message)
 
         self.response_format="json_object"
+        self.cache_file = TAG_CACHE_FILE if TAG_CACHE_SIZE > 0 else "" # "" disables caching of replacements
         
     def send_request(self, tags):
+        return self.send_request_batch([tags])[0]
+
+    # Simplify several independent lists of tags. Each list needs two 
+    # consecutive requests, the lists themselves are processed in parallel.
+    # Returns a list of replacement-lists in the order of list_of_tags
+    def send_request_batch(self, list_of_tags):
+        cache = self.read_cache()
+        cache_keys = [self.get_cache_key(tags) for tags in list_of_tags]
+        results = [cache.get(cache_key) for cache_key in cache_keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if len(missing) < len(list_of_tags):
+            logging.info("Using cached tag replacements")
+        if not missing:
+            return results
+
+        with ThreadPoolExecutor(max_workers=REQUEST_CONCURRENCY) as executor:
+            answers = executor.map(self.simplify_tags, [list_of_tags[i] for i in missing])
+            for i, replacements in zip(missing, answers):
+                results[i] = replacements
+                # Failed answers ({}) are not cached
+                if isinstance(replacements, list):
+                    cache[cache_keys[i]] = replacements
+
+        self.write_cache(cache)
+        return [result if result is not None else {} for result in results]
+
+    # Both requests for one list of tags. Every list is sent as a 
+    # separate conversation, so that several lists can be simplified 
+    # in parallel without sharing self.messages
+    def simplify_tags(self, tags):
         # Step 1: Simplify and summarize tags
         message = f"Improve the following tags: {tags}"
-        
-        self.add_message(message, role="user")
+        messages = self.messages + [{"role": "user", "content": message}]
+
+        response = super().send_request(temperature=0.3, response_format = self.response_format, messages=messages)
 
-        response = super().send_request(temperature=0.3, response_format = self.response_format)
+        # Only a few replacements? Then a reevaluation is not worth a second request
+        replacements = self.parse_replacements(response)
+        if replacements is not None and len(replacements) < TAG_REEVALUATION_THRESHOLD:
+            logging.debug("Only %d replacements, skipping reevaluation", len(replacements))
+            return replacements
         
         # Now we do a second request to optimize the result
         message2 = """
@@ -343,23 +607,58 @@ class AIAgent_OpenAI_pdf_tag_analysis(AIAgent_OpenAI):
         are preserved and the response is complete and correct. 
         Respond in the same JSON format.
         """
-        self.add_message(response, "assistant")
-        self.add_message(message2, "user")
+        messages = messages + [
+            {"role": "assistant", "content": response},
+            {"role": "user", "content": message2}
+        ]
 
         logging.debug("Optimizing response...")
-        response = response = super().send_request(temperature=0.3, response_format = self.response_format)
+        response = super().send_request(temperature=0.3, response_format = self.response_format, messages=messages)
         
-        try: 
-            replacements = json.loads(response)
-            replacements = replacements['replacements']
-        except Exception as e: 
-            logging.error("Could not interpret AI answer for tag simplification: " + pprint.pformat(response))
-            replacements = {}
+        replacements = self.parse_replacements(response)
+        if replacements is None:
+            logging.error("Could not interpret AI answer for tag simplification: " + str(response))
+            return {}
+        return replacements
 
+    # List of replacements in an AI answer, None if it can't be interpreted
+    def parse_replacements(self, response):
+        try: 
+            replacements = fastjson.loads(response)['replacements']
+        except Exception: 
+            return None
+        if not isinstance(replacements, list):
+            return None
         return replacements
 
-def num_tokens_from_string(string: str, encoding_name: str = "cl100k_base") -> int:
-    """Returns the number of tokens in a text string."""
-    encoding = tiktoken.get_encoding(encoding_name)
-    num_tokens = len(encoding.encode(string))
-    return num_tokens
\ No newline at end of file
+    # The key only depends on the set of tags and the model used
+    def get_cache_key(self, tags):
+        key_data = json.dumps([self.model, sorted(tags)])
+        return hashlib.blake2b(key_data.encode(), digest_size=16).hexdigest()
+
+    def read_cache(self):
+        if not self.cache_file:
+            return {}
+        try:
+            with open(self.cache_file, 'rb') as f:
+                cache = fastjson.loads(f.read())
+            # Ignore files that do not contain a JSON object
+            return cache if isinstance(cache, dict) else {}
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logging.error("Error reading tag cache: {}".format(e))
+            return {}
+
+    def write_cache(self, cache):
+        if not self.cache_file:
+            return
+        # Forget the oldest replacements if the cache is full
+        for cache_key in list(cache)[:max(0, len(cache) - TAG_CACHE_SIZE)]:
+            del cache[cache_key]
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            with open(self.cache_file, 'w', encoding='utf-8') as f:
+                f.write(fastjson.dumps(cache))
+        except Exception as e:
+            logging.error("Error writing tag cache: {}".format(e))
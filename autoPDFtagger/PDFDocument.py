@@ -14,14 +14,22 @@ ensure a reliable and accurate representation of document information.
 """
 
 import os
-import json
-import fitz 
+import copy
+import functools
+from pathlib import PurePath
+# PyMuPDF (fitz) is a large extension, it is only imported by the methods 
+# working on the PDF itself (documents loaded from a JSON- or CSV-database 
+# often don't need it at all)
 import logging
 import re
-import base64
-from datetime import datetime
-import pytz
+# pybase64 (SIMD-accelerated) is used for encoding images if installed
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
+from datetime import datetime, timedelta, timezone
 import traceback
+from autoPDFtagger import fastjson
 
 
 date_formats = {
@@ -37,15 +45,109 @@ date_formats = {
     r'\d{2} [a-zA-Z]{3} \d{4}': "%d %b %Y"   # DD Mon YYYY
 }
 
+# Compiled once at import: (pattern, format)
+DATE_PATTERNS = tuple((re.compile(regex), date_format) for regex, date_format in date_formats.items())
+
+# All formats in one pattern: a text without any match (the common case)
+# is scanned only once instead of once per format
+ANY_DATE_PATTERN = re.compile("|".join(f"(?:{regex})" for regex in date_formats))
+
+# Documents often share the same dates (e.g. from file names or a 
+# database), every date string is only parsed once per process
+@functools.lru_cache(maxsize=4096)
+def parse_date(date_string):
+    """
+    Converts a date string of one of the date_formats to a datetime object.
+    Returns None if the string doesn't match any format.
+    """
+    for pattern, date_format in DATE_PATTERNS:
+        if pattern.match(date_string):
+            try:
+                # Fixed-width digits (YYYYMMDD) don't need strptime
+                if date_format == "%Y%m%d" and len(date_string) == 8:
+                    return datetime(int(date_string[0:4]), int(date_string[4:6]), int(date_string[6:8]))
+                return datetime.strptime(date_string, date_format)
+            except ValueError:
+                continue  # Try the next format if the current one does not match
+    return None
+
+# Cleaning up a file name to be used as title
+TITLE_UNWANTED_REGEX = re.compile(r'[^\w\s.-]')
+TITLE_TRIM_REGEX = re.compile(r'^-|\.pdf$')
+
+# Cleaning up extracted text: line breaks become spaces, 
+# all other characters not listed here are removed
+OCR_ALLOWED_CHARACTERS = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 .:äöüÄÖÜß/"
+
+class OCRCleanupTable(dict):
+    """
+    Translation table for str.translate: allowed characters are kept, 
+    line breaks become spaces and every other character is removed. 
+    Removed characters are added to the table when they occur first.
+    """
+    def __missing__(self, char):
+        self[char] = None
+        return None
+
+OCR_CLEANUP_TABLE = OCRCleanupTable({ord(char): ord(char) for char in OCR_ALLOWED_CHARACTERS})
+OCR_CLEANUP_TABLE.update({ord('\n'): ord(' '), ord('\r'): ord(' ')})
+
+# Confidence values stored in the keywords by save_to_file
+CONFIDENCE_REGEX = re.compile(
+    r"(?P<field>title|summary|creation_date|creator)_confidence=(?P<value>\d+\.?\d*)"
+    r"|tag_confidence=(?P<tags>[\d,.]+)"
+)
+
+# Words counted on each page: at least 3 letters
+PAGE_WORD_REGEX = re.compile(r'[a-zA-ZäöüÄÖÜß]{3,}')
+
+# Maximum length of the text read from a document. The AI only gets 
+# a limited number of tokens (16k for the largest model, about 4 
+# characters each), the rest of long documents is never used
+MAX_TEXT_CHARS = 65536
+
+# Confidence of the creationDate of a PDF which was not saved by 
+# autoPDFtagger: usually the date of scanning or producing the file, 
+# not of the document itself
+PDF_CREATION_DATE_CONFIDENCE = 2
+
+# Format of new file names, see create_new_filename
+DEFAULT_FILENAME_FORMAT = "%Y-%m-%d-{CREATOR}-{TITLE}.pdf"
+
+# Results of analyze_document_images, which is done on first access
+IMAGE_ANALYSIS_ATTRIBUTES = ("pages", "images", "image_coverage", "total_image_area", "total_page_area")
+
+# Fields which can be set from a dictionary (e.g. an AI answer):
+# (field, confidence field, setter method)
+FIELD_SETTERS = (
+    ("title", "title_confidence", "set_title"),
+    ("summary", "summary_confidence", "set_summary"),
+    ("creation_date", "creation_date_confidence", "set_creation_date"),
+    ("creator", "creator_confidence", "set_creator"),
+    ("importance", "importance_confidence", "set_importance"),
+    ("tags", "tags_confidence", "set_tags"),
+)
+
+# Attributes written to the PDF-file by save_to_file
+SAVED_ATTRIBUTES = (
+    "title", "title_confidence", "summary", "summary_confidence", 
+    "creation_date", "creation_date_confidence", "creator", "creator_confidence", 
+    "tag_confidence_map",
+)
+
 class PDFDocument:
     """
     Class for handling operations on PDF documents.
     Includes reading, analyzing, and extracting information from PDF files.
     """
-    def __init__(self, path, base_directory):
+    def __init__(self, path, base_directory, stat_result=None, max_text_chars=MAX_TEXT_CHARS):
+        # stat_result: os.stat_result of the file if already known 
+        # (e.g. from os.scandir), saves another stat() of the file
+        # max_text_chars: reading the text (read_ocr) stops after this 
+        # number of characters, None to read the whole document
 
         # Validate and initialize file paths
-        if not os.path.exists(path):
+        if stat_result is None and not os.path.exists(path):
             raise ValueError(f"File {path} does not exist")
         if not os.path.exists(base_directory):
             raise ValueError(f"Basedirectory {base_directory} does not exist")
@@ -53,6 +155,7 @@ class PDFDocument:
         self.folder_path_abs = os.path.dirname(os.path.abspath(path))
         self.base_directory_abs = os.path.abspath(base_directory)
         self.relative_path = os.path.relpath(self.folder_path_abs, self.base_directory_abs)
+        self.absolute_path = os.path.join(self.folder_path_abs, self.file_name)
 
         # Initialize parameters for analysis
         self.summary = ""
@@ -63,21 +166,60 @@ class PDFDocument:
         self.creation_date_confidence = 0
         self.creator = ""
         self.creator_confidence = 0
-        self.tags = []
-        self.tags_confidence = []
+        self.tag_confidence_map = {} # confidence of each tag, in order of the tags
         self.importance = None
         self.importance_confidence = 0
 
         # Analyze document
-        self.modification_date = self.get_modification_date()
-        self.pages = []
-        self.images = []
+        self.modification_date = self.get_modification_date(stat_result)
+        # pages, images and image_coverage are set by analyze_document_images 
+        # when they are used first (see __getattr__)
         self.images_already_analyzed = False
-        self.image_coverage = None
         self.pdf_text = ""
+        self.max_text_chars = max_text_chars
+        self.image_cache = {} # base64-encoded images by (xref, "png") or (xref, max_size, quality) for JPEG
+        self.fitz_document = None # opened PDF, see get_fitz_document
+        self.page_texts = [] # text of each page, collected by read_ocr or analyze_document_images
+
+    def __getattr__(self, name):
+        """
+        Analyzes the images and pages of the document when one of the 
+        results (e.g. pages) is used the first time. Only called for 
+        attributes which are not set yet.
+        """
+        if name in IMAGE_ANALYSIS_ATTRIBUTES and not self.__dict__.get("images_already_analyzed"):
+            self.analyze_document_images()
+            return getattr(self, name)
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
 
     def get_absolute_path(self):
-        return os.path.join(self.folder_path_abs, self.file_name)
+        return self.absolute_path
+
+    def get_fitz_document(self):
+        """
+        Returns the PDF opened with PyMuPDF. The file is opened on first use and 
+        shared by all analysis steps until close() is called, so that its 
+        structure (xref table, trailer) only needs to be parsed once.
+        """
+        if self.fitz_document is None:
+            import fitz
+            self.fitz_document = fitz.open(self.get_absolute_path())
+        return self.fitz_document
+
+    def close(self):
+        """
+        Closes the opened PDF (if any). It is opened again when needed.
+        """
+        if self.fitz_document is not None:
+            self.fitz_document.close()
+            self.fitz_document = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
 
     # Get text stored inside the document
     def get_pdf_text(self):
@@ -86,10 +228,12 @@ class PDFDocument:
         return self.pdf_text
             
 
-    def analyze_file(self):
+    def analyze_file(self, include_metadata=True):
         """
         Performs an analysis of the document. 
         It extracts the date, title, and tags from the document's filename and relative path.
+        The metadata stored inside the PDF is only read if include_metadata is set, 
+        otherwise the file doesn't need to be opened at all.
         """
         # Extract the creation date from the file name
         self.extract_date_from_filename()
@@ -101,7 +245,8 @@ class PDFDocument:
         self.extract_tags_from_relative_path()
 
         # Extract useful information from Metadata
-        self.extract_metadata()
+        if include_metadata:
+            self.extract_metadata()
  
     def save_to_file(self, new_file_path):
         """
@@ -111,7 +256,10 @@ class PDFDocument:
         # Ensure the directory for the new file exists
         os.makedirs(os.path.dirname(new_file_path), exist_ok=True)
 
-        # Open the existing PDF document
+        # Open the existing PDF document separately: the metadata is changed 
+        # on this handle, the one used for the analysis (get_fitz_document) 
+        # keeps reading the original file
+        import fitz
         pdf_document = fitz.open(self.get_absolute_path())
 
         # Update the metadata of the PDF document
@@ -119,16 +267,16 @@ class PDFDocument:
         metadata['title'] = self.title
         metadata['summary'] = self.summary
         metadata['author'] = self.creator
-        metadata['keywords'] = ', '.join(self.tags)
+        metadata['keywords'] = ', '.join(self.tag_confidence_map)
 
         # Storing additional information about confidences in keyword-list
-        tags_confidence_str = ','.join([str(conf) for conf in self.tags_confidence])
+        tags_confidence_str = ','.join(map(str, self.tag_confidence_map.values()))
         metadata['keywords'] = f"{metadata['keywords']} - Metadata automatically updated by autoPDFtagger, title_confidence={self.title_confidence}, summary_confidence={self.summary_confidence}, creation_date_confidence={self.creation_date_confidence}, creator_confidence={self.creator_confidence}, tag_confidence={tags_confidence_str}"
 
         if self.creation_date:
             # Konvertiere das Datum in das PDF-Format
             # Annahme: Die Zeitzone ist UTC
-            utc_creation_date = self.creation_date.astimezone(pytz.utc)
+            utc_creation_date = self.creation_date.astimezone(timezone.utc)
             metadata['creationDate'] = utc_creation_date.strftime("D:%Y%m%d%H%M%S+00'00'")
 
         pdf_document.set_metadata(metadata)
@@ -145,7 +293,7 @@ class PDFDocument:
         This includes paths, text content, metadata, and analyzed information.
         """
         pdf_dict = {
-            "folder_path_abs": os.path.dirname(self.get_absolute_path()),
+            "folder_path_abs": self.folder_path_abs,
             "relative_path": self.relative_path,
             "base_directory_abs": self.base_directory_abs,
             "file_name": self.file_name,
@@ -165,12 +313,30 @@ class PDFDocument:
         return pdf_dict
 
 
+    def clone_metadata(self):
+        """
+        Creates a copy of the document whose metadata can be modified independently.
+        Analysis data (text, pages, images) is shared with the original instead of being copied.
+        """
+        clone = copy.copy(self)
+        clone.tag_confidence_map = dict(self.tag_confidence_map)
+        return clone
+
+    @property
+    def tags(self):
+        return list(self.tag_confidence_map)
+
+    @property
+    def tags_confidence(self):
+        return list(self.tag_confidence_map.values())
+
+
     def to_api_json(self):
         """
         Converts selected attributes of the PDF document into a JSON string.
         This JSON representation can be used for API interactions.
         """
-        return json.dumps({
+        return fastjson.dumps({
             "summary": self.summary,
             "summary_confidence": self.summary_confidence,
             "title": self.title,
@@ -187,24 +353,30 @@ class PDFDocument:
 
     def read_ocr(self):
         """
-        Reads and extracts text from all pages of the PDF document.
+        Reads and extracts text from the pages of the PDF document (up to max_text_chars).
         Cleans the text by removing non-readable characters and replacing line breaks.
         """
         try:
-            pdf_document = fitz.open(self.get_absolute_path())
-
-            # Initialize text extraction
-            pdf_text = ""
-            for page_num in range(len(pdf_document)):
-                page = pdf_document[page_num]
-                page_text = page.get_text("text")
-                pdf_text += page_text
+            # Collect the text of all pages and join it once. The page texts 
+            # are kept for analyze_document_images (and reused from it), so 
+            # every page's text is only extracted once
+            if not self.page_texts:
+                # Stop as soon as enough text is collected
+                page_texts = []
+                total_chars = 0
+                for page in self.get_fitz_document():
+                    page_texts.append(page.get_text("text"))
+                    total_chars += len(page_texts[-1])
+                    if self.max_text_chars and total_chars >= self.max_text_chars:
+                        break
+                self.page_texts = page_texts
+            pdf_text = "".join(self.page_texts)
+            if self.max_text_chars:
+                pdf_text = pdf_text[:self.max_text_chars]
 
             # Clean text by removing unwanted characters and line breaks
-            pdf_text = pdf_text.replace('\n', ' ').replace('\r', ' ')
-            pdf_text = re.sub(r'[^a-zA-Z0-9 .:äöüÄÖÜß/]+', '', pdf_text)
+            pdf_text = pdf_text.translate(OCR_CLEANUP_TABLE)
 
-            pdf_document.close()
             #logging.debug(f"Extracted text from {self.file_name}:\n{self.pdf_text}\n----------------\n")
             return pdf_text
 
@@ -219,8 +391,7 @@ class PDFDocument:
         The thumbnail is saved as a PNG image.
         """
         try:
-            pdf_path = self.get_absolute_path()
-            pdf_document = fitz.open(pdf_path)
+            pdf_document = self.get_fitz_document()
             
             # Select the first page for the thumbnail
             page = pdf_document[0]
@@ -228,7 +399,6 @@ class PDFDocument:
             # Create a pixmap object from the page and save as a PNG image
             pix = page.get_pixmap(dpi=50)
             pix.save(thumbnail_filename)
-            pdf_document.close()
 
             logging.info(f"Thumbnail created: {thumbnail_filename}")
             return
@@ -241,11 +411,15 @@ class PDFDocument:
         """
         Extracts a PNG image from the PDF using its xref (cross-reference) and encodes it in base64.
         This method is useful for extracting and transmitting images in a format suitable for web use.
+        Encoded images are cached, so every image is only extracted once.
         """
+        if (xref, "png") in self.image_cache:
+            return self.image_cache[(xref, "png")]
+
         logging.debug(f"Extracting Image {xref} from Document {self.file_name}")
         try:
-            pdf_path = self.get_absolute_path()
-            pdf_fitz = fitz.open(pdf_path)
+            import fitz
+            pdf_fitz = self.get_fitz_document()
 
             # Create a pixmap (image) object from the PDF based on the provided xref
             pix = fitz.Pixmap(pdf_fitz, xref)
@@ -254,18 +428,84 @@ class PDFDocument:
             img_bytes = pix.tobytes("png")
             encoded_image = base64.b64encode(img_bytes).decode()
 
-            pdf_fitz.close()
             logging.debug("Returning " + str(len(encoded_image)) + " character base_64")
+            self.image_cache[(xref, "png")] = encoded_image
             return encoded_image
 
         except Exception as e:
             logging.error(f"Error extracting PNG image by xref: {e}")
             return None
 
+    def get_jpeg_image_base64_by_xref(self, xref, max_size=2048, quality=85):
+        """
+        Extracts an image from the PDF using its xref, downscales it to at most max_size pixels
+        on the long edge and encodes it as base64 JPEG. Much smaller than PNG for photos and scans,
+        therefore used for uploading images to the AI. Encoded images are cached.
+        """
+        return self.get_jpeg_images_base64_by_xrefs([xref], max_size, quality)[0]
 
-    def get_modification_date(self):
+    def get_jpeg_images_base64_by_xrefs(self, xrefs, max_size=2048, quality=85):
+        """
+        Same as get_jpeg_image_base64_by_xref for a list of xrefs. The PDF is only
+        opened once for all images which are not cached yet.
+        Returns a list of base64 strings (None for images which could not be extracted).
+        """
+        # JPEG images are cached separately for every size and quality
+        missing = [xref for xref in xrefs if (xref, max_size, quality) not in self.image_cache]
+        if missing:
+            try:
+                import fitz
+                pdf_fitz = self.get_fitz_document()
+            except Exception as e:
+                logging.error(f"Error extracting JPEG image by xref: {e}")
+                return [self.image_cache.get((xref, max_size, quality)) for xref in xrefs]
+
+            for xref in missing:
+                logging.debug("Extracting Image %s from Document %s", xref, self.file_name)
+                try:
+                    # Images which are stored as small enough JPEG (RGB or grayscale)
+                    # are used as they are, without decoding and encoding them again
+                    raw_image = pdf_fitz.extract_image(xref)
+                    if (raw_image and raw_image["ext"] in ("jpeg", "jpg") 
+                            and raw_image["colorspace"] in (1, 3)
+                            and max(raw_image["width"], raw_image["height"]) <= max_size):
+                        img_bytes = raw_image["image"]
+                    else:
+                        pix = fitz.Pixmap(pdf_fitz, xref)
+
+                        # Halve large images cheaply in place first (before 
+                        # converting colors or interpolating), then scale exactly
+                        while max(pix.width, pix.height) >= 2 * max_size:
+                            pix.shrink(1)
+
+                        # JPEG supports neither transparency nor every colorspace
+                        if pix.alpha:
+                            pix = fitz.Pixmap(pix, 0)
+                        if not pix.colorspace or pix.colorspace.n not in (1, 3):
+                            pix = fitz.Pixmap(fitz.csRGB, pix)
+
+                        scale = max_size / max(pix.width, pix.height)
+                        if scale < 1:
+                            pix = fitz.Pixmap(pix, int(pix.width * scale), int(pix.height * scale), None)
+
+                        img_bytes = pix.tobytes("jpeg", jpg_quality=quality)
+                    encoded_image = base64.b64encode(img_bytes).decode()
+
+                    logging.debug("Returning %d character base_64", len(encoded_image))
+                    self.image_cache[(xref, max_size, quality)] = encoded_image
+
+                except Exception as e:
+                    logging.error(f"Error extracting JPEG image by xref: {e}")
+
+        return [self.image_cache.get((xref, max_size, quality)) for xref in xrefs]
+
+
+    def get_modification_date(self, stat_result=None):
         try:
-            modification_date = os.path.getmtime(self.get_absolute_path())
+            if stat_result is not None:
+                modification_date = stat_result.st_mtime
+            else:
+                modification_date = os.path.getmtime(self.get_absolute_path())
             modification_date = datetime.fromtimestamp(modification_date)
             return modification_date
         except Exception as e:
@@ -276,19 +516,22 @@ class PDFDocument:
         Extracts the creation date from the file name using predefined regular expressions.
         Sets the creation date of the document if a matching date format is found.
         """
-        for regex, date_format in date_formats.items():
-            date_match = re.search(regex, self.file_name)
+        # File names without a date (the common case) are scanned only once. 
+        # Otherwise the formats are tried in the order of their priority 
+        # (not by position in the file name)
+        if not ANY_DATE_PATTERN.search(self.file_name):
+            return None
+
+        for pattern, _ in DATE_PATTERNS:
+            date_match = pattern.search(self.file_name)
             if date_match:
-                date_string = date_match.group()
-                try:
-                    # Parse the date string according to the matched format
-                    date_object = datetime.strptime(date_string, date_format)
+                # Parse the date string (cached, see parse_date), 
+                # continue searching if it is not a valid date
+                date_object = parse_date(date_match.group())
+                if date_object:
                     # Set the creation date with a high confidence level
-                    self.set_creation_date(date_object.strftime("%Y-%m-%d"), 8)
+                    self.set_if_higher("creation_date", date_object, 8)
                     return
-                except ValueError:
-                    # Continue searching if the current format does not match
-                    continue
 
         # Return None if no date format matches
         return None
@@ -299,14 +542,12 @@ class PDFDocument:
         Extracts the title from the file name by removing date information and unwanted characters.
         Sets the title of the document with a moderate confidence level.
         """
-        # Remove date from the file name
-        file_name = self.file_name
-        for regex in date_formats:
-            file_name = re.sub(regex, '', file_name).strip()
+        # Remove dates (of all formats) from the file name in one pass
+        file_name = ANY_DATE_PATTERN.sub('', self.file_name).strip()
 
         # Remove additional characters and use the rest as the title
-        file_name = re.sub(r'[^\w\s.-]', '', file_name)
-        file_name = re.sub(r'^-|\.pdf$', '', file_name)
+        file_name = TITLE_UNWANTED_REGEX.sub('', file_name)
+        file_name = TITLE_TRIM_REGEX.sub('', file_name)
 
         # Set the extracted file name as the title
         self.set_title(file_name, 2)
@@ -318,14 +559,12 @@ class PDFDocument:
         Tags are derived from the directory names in the path.
         Sets the extracted tags with a moderate confidence level.
         """
-        # Split the relative path by the directory separator and clean up tags
-        tags = self.relative_path.split(os.path.sep)
-        tags = [tag.strip() for tag in tags if tag.strip()]  # Remove empty entries
-        tags = [tag.strip() for tag in tags if tag != "."]
+        # Split the relative path into its directories (PurePath already 
+        # drops empty parts and ".") and clean up tags
+        tags = [tag.strip() for tag in PurePath(self.relative_path).parts if tag.strip()]
         # Set extracted tags if any are found
         if tags:
-            self.tags = tags
-            self.tags_confidence = [6] * len(tags)  # Moderate confidence for each tag
+            self.tag_confidence_map = dict.fromkeys(tags, 6)  # Moderate confidence for each tag
 
     def extract_metadata(self):
         """
@@ -333,25 +572,26 @@ class PDFDocument:
         Updates the class attributes based on the extracted metadata.
         """
         try:
-            pdf_document = fitz.open(self.get_absolute_path())
+            pdf_document = self.get_fitz_document()
             metadata = pdf_document.metadata
 
             # Default confidence value
             default_confidence = 5
 
-            def extract_confidence(pattern, text, default_confidence):
-                """Extracts a confidence value using regex or returns the default value."""
-                match = re.search(pattern, text)
-                return float(match.group(1)) if match else default_confidence
-
-
-            # Extract confidence values
+            # Extract confidence values in a single pass over the keywords
+            # (the first value found for each field is used)
             keywords = metadata.get('keywords', '')
-            title_conf = extract_confidence(r"title_confidence=(\d+\.?\d*)", keywords, default_confidence)
-            summary_conf = extract_confidence(r"summary_confidence=(\d+\.?\d*)", keywords, default_confidence)
-            creation_date_conf = extract_confidence(r"creation_date_confidence=(\d+\.?\d*)", keywords, default_confidence)
-            creator_conf = extract_confidence(r"creator_confidence=(\d+\.?\d*)", keywords, default_confidence)
-            tags_conf_str = extract_confidence(r"tag_confidence=([\d,.]+)", keywords, '')
+            confidences = {}
+            tags_conf_str = ''
+            for match in CONFIDENCE_REGEX.finditer(keywords):
+                if match.group('field'):
+                    confidences.setdefault(match.group('field'), float(match.group('value')))
+                elif not tags_conf_str:
+                    tags_conf_str = match.group('tags')
+            title_conf = confidences.get('title', default_confidence)
+            summary_conf = confidences.get('summary', default_confidence)
+            creation_date_conf = confidences.get('creation_date', PDF_CREATION_DATE_CONFIDENCE)
+            creator_conf = confidences.get('creator', default_confidence)
 
             # Set metadata values if not empty
             if metadata.get('title'):
@@ -359,17 +599,22 @@ class PDFDocument:
             if metadata.get('summary'):
                 self.set_summary(metadata['summary'], summary_conf)
             if metadata.get('creationDate'):
-                self.set_creation_date(metadata['creationDate'], creation_date_conf)
+                # PDF date format, e.g. "D:20150919085148+02'00'"
+                creation_date = pdf_date_to_datetime(metadata['creationDate'])
+                if creation_date:
+                    # Dates are kept in local time without timezone,
+                    # like the ones parsed from file names
+                    if creation_date.tzinfo:
+                        creation_date = creation_date.astimezone().replace(tzinfo=None)
+                    self.set_if_higher("creation_date", creation_date, creation_date_conf)
             if metadata.get('author'):
                 self.set_creator(metadata['author'], creator_conf)
 
             # Process tag confidence values
-            tag_confidences = [float(conf) for conf in tags_conf_str.split(',')] if tags_conf_str else [default_confidence]
+            tag_confidences = list(map(float, filter(None, tags_conf_str.split(',')))) or [default_confidence]
             keywords = metadata.get('keywords', '').split(', ')[:len(tag_confidences)]
             self.set_tags(keywords, tag_confidences)
 
-            pdf_document.close()
-
         except Exception as e:
             logging.error(f"Error extracting metadata from {self.file_name}: {e}")
             traceback.print_exc()
@@ -383,16 +628,15 @@ class PDFDocument:
         if self.images_already_analyzed:
             return
         
-        pdf_path = self.get_absolute_path()
-        pdf_document = fitz.open(pdf_path)
+        pdf_document = self.get_fitz_document()
 
         self.images = []
         self.pages = []
+        # Page texts already extracted by read_ocr are reused
+        page_texts = list(self.page_texts)
         self.total_image_area = 0
         self.total_page_area = 0
 
-        word_regex = re.compile(r'[a-zA-ZäöüÄÖÜß]{3,}')
-
         for page_num, page in enumerate(pdf_document):
             page_images, page_image_area, max_img_xref = self.analyze_page_images(page)
             page_data = self.analyze_page_data(page, page_num, max_img_xref)
@@ -406,10 +650,14 @@ class PDFDocument:
             self.total_page_area += page_data['page_area']
 
             # Extract and count words on the page
-            page_text = page.get_text("text")
-            page_data['words_count'] = len(word_regex.findall(page_text))
+            if page_num < len(page_texts):
+                page_text = page_texts[page_num]
+            else:
+                page_text = page.get_text("text")
+                page_texts.append(page_text)
+            page_data['words_count'] = sum(1 for _ in PAGE_WORD_REGEX.finditer(page_text))
 
-        pdf_document.close()
+        self.page_texts = page_texts
 
         # Calculate the percentage of the document covered by images
         self.image_coverage = (self.total_image_area / self.total_page_area) * 100 if self.total_page_area > 0 else 0        
@@ -420,11 +668,12 @@ class PDFDocument:
         """
         Analyzes basic data of a page such as dimensions and area.
         """
-        page_area = page.rect.width * page.rect.height
+        page_rect = page.rect
+        page_area = page_rect.width * page_rect.height
         return {
             "page_number": page_num + 1,
-            "width": page.rect.width,
-            "height": page.rect.height,
+            "width": page_rect.width,
+            "height": page_rect.height,
             "page_area": page_area,
             "max_img_xref": max_img_xref
         }
@@ -433,6 +682,8 @@ class PDFDocument:
         """
         Analyzes images on a page, extracting details and calculating the total image area.
         """
+        page_rect = page.rect
+        page_area = page_rect.width * page_rect.height
         page_images = []
         page_image_area = 0
         images = page.get_images(full=True)
@@ -440,7 +691,7 @@ class PDFDocument:
         max_img_xref = None
 
         for img in images:
-            image_data = self.extract_image_data(page, img)
+            image_data = self.extract_image_data(page, img, page_area)
             page_images.append(image_data)
             page_image_area += image_data['area']
 
@@ -451,7 +702,7 @@ class PDFDocument:
 
         return page_images, page_image_area, max_img_xref
 
-    def extract_image_data(self, page, img):
+    def extract_image_data(self, page, img, page_area):
         """
         Extracts data of a single image, including dimensions, area, and coverage percentage.
         """
@@ -461,28 +712,36 @@ class PDFDocument:
             rect = img_rects[0]
             img_area = rect.width * rect.height
 
-        pix = fitz.Pixmap(page.parent, xref)
+        # Size in pixels is listed by get_images, no need to decode the image
         return {
             "xref": xref,
             "width": rect.width if rect else 0,
             "height": rect.height if rect else 0,
-            "original_width": pix.width,
-            "original_height": pix.height,
+            "original_width": img[2],
+            "original_height": img[3],
             "area": img_area,
-            "page_coverage_percent": (img_area / page.rect.width * page.rect.height) * 100 if rect else 0
+            "page_coverage_percent": (img_area / page_area) * 100 if rect and page_area else 0
         }
    
 
 
+    def set_if_higher(self, field, value, confidence):
+        """
+        Sets a field (e.g. "title") of the document and its confidence field 
+        ("title_confidence"), if the confidence is equal to or higher than the current one.
+        """
+        if confidence >= getattr(self, field + "_confidence"):
+            setattr(self, field, value)
+            setattr(self, field + "_confidence", confidence)
+        elif logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info("%s not set due to lower confidence-level", field)
+
     def set_title(self, title, confidence):
         """
         Sets the title of the document with a given confidence level.
         The title is updated only if the new confidence level is equal to or higher than the current level.
         """
-        if confidence >= self.title_confidence:
-            self.title = title
-            self.title_confidence = confidence
-        else: logging.info("Title not set due to lower confidence-level")
+        self.set_if_higher("title", title, confidence)
 
     def set_creation_date(self, creation_date, confidence):
         """
@@ -493,20 +752,9 @@ class PDFDocument:
             self.creation_date = None
             return
         
-        date_obj = None
-        for regex, date_format in date_formats.items():
-            if re.match(regex, creation_date):
-                try:
-                    date_obj = datetime.strptime(creation_date, date_format)
-                    break
-                except ValueError:
-                    continue  # Try the next format if the current one does not match
-
+        date_obj = parse_date(creation_date)
         if date_obj:
-            if confidence >= self.creation_date_confidence:
-                self.creation_date = date_obj
-                self.creation_date_confidence = confidence
-            else: logging.info("Creation date not set due to lower confidence-level")
+            self.set_if_higher("creation_date", date_obj, confidence)
         
 
         
@@ -515,31 +763,21 @@ class PDFDocument:
         Sets the summary of the document with a given confidence level.
         The summary is updated only if the new confidence level is equal to or higher than the current level.
         """
-        if confidence >= self.summary_confidence:
-            self.summary = summary
-            self.summary_confidence = confidence
-        else: logging.info("Summary not set due to lower confidence-level")
+        self.set_if_higher("summary", summary, confidence)
 
     def set_creator(self, creator, confidence):
         """
         Sets the creator of the document with a given confidence level.
         The creator is updated only if the new confidence level is equal to or higher than the current level.
         """
-        if confidence >= self.creator_confidence:
-            self.creator = creator
-            self.creator_confidence = confidence
-        
-        else: logging.info("Creator not set due to lower confidence-level")
+        self.set_if_higher("creator", creator, confidence)
 
     def set_importance(self, importance, confidence):
         """
         Sets the importance of the document with a given confidence level.
         The importance is updated only if the new confidence level is equal to or higher than the current level.
         """
-        if confidence >= self.importance_confidence:
-            self.importance = importance
-            self.importance_confidence = confidence
-        else: logging.info("Importance not set due to lower confidence-level")
+        self.set_if_higher("importance", importance, confidence)
 
     def set_tags(self, tag_list, confidence_list):
         """
@@ -550,9 +788,11 @@ class PDFDocument:
         if len(tag_list) != len(confidence_list):
             raise ValueError("Length of tag_list and confidence_list must be equal.")
 
+        # Tags which are already known keep their highest confidence
         for tag, confidence in zip(tag_list, confidence_list):
-            self.tags.append(tag)
-            self.tags_confidence.append(confidence)
+            current = self.tag_confidence_map.get(tag)
+            if current is None or confidence > current:
+                self.tag_confidence_map[tag] = confidence
 
     def set_from_json(self, input_json):
         """
@@ -561,7 +801,9 @@ class PDFDocument:
         """
         try:
             # Convert the JSON string into a Python dictionary
-            input_dict = json.loads(input_json)
+            input_dict = fastjson.loads(input_json)
+            if not isinstance(input_dict, dict):
+                raise ValueError("JSON object expected, got " + type(input_dict).__name__)
 
             # Update values in the PDFDocument object using the dictionary
             self.set_from_dict(input_dict)
@@ -578,42 +820,36 @@ class PDFDocument:
         The dictionary should contain key-value pairs corresponding to the attributes of the PDFDocument.
         """
 
-        # Update the title if provided in the input dictionary
-        if 'title' in input_dict and 'title_confidence' in input_dict:
-            self.set_title(input_dict['title'], input_dict['title_confidence'])
-
-        # Update the summary if provided in the input dictionary
-        if 'summary' in input_dict and 'summary_confidence' in input_dict:
-            self.set_summary(input_dict['summary'], input_dict['summary_confidence'])
-
-        # Update the creation date if provided in the input dictionary
-        if 'creation_date' in input_dict and 'creation_date_confidence' in input_dict:
-            self.set_creation_date(input_dict['creation_date'], input_dict['creation_date_confidence'])
-
-        # Update the creator if provided in the input dictionary
-        if 'creator' in input_dict and 'creator_confidence' in input_dict:
-            self.set_creator(input_dict['creator'], input_dict['creator_confidence'])
-
-
-        # Update the importance if provided in the input dictionary
-        if 'importance' in input_dict and 'importance_confidence' in input_dict:
-            self.set_importance(input_dict['importance'], input_dict['importance_confidence'])
+        # Update every field provided together with its confidence in the input dictionary.
+        # An invalid field (e.g. a confidence which is not a number) is skipped 
+        # without losing the other fields
+        for field, confidence_field, setter in FIELD_SETTERS:
+            if field in input_dict and confidence_field in input_dict:
+                try:
+                    getattr(self, setter)(input_dict[field], input_dict[confidence_field])
+                except (TypeError, ValueError) as e:
+                    logging.error(f"Invalid value for {field} ignored: {e}")
 
-        # Update the tags if provided in the input dictionary
-        if 'tags' in input_dict and 'tags_confidence' in input_dict:
-            self.set_tags(input_dict['tags'], input_dict['tags_confidence'])
 
 
+    def merge_from(self, other):
+        """
+        Updates the attributes of the PDFDocument object from another PDFDocument 
+        (e.g. the same file imported twice), following the same confidence rules 
+        as set_from_dict, but without converting the other document to a dictionary.
+        """
+        for field in ("title", "summary", "creator", "importance"):
+            self.set_if_higher(field, getattr(other, field), getattr(other, field + "_confidence"))
+        if other.creation_date:
+            self.set_if_higher("creation_date", other.creation_date, other.creation_date_confidence)
+        self.set_tags(other.tags, other.tags_confidence)
 
     def get_confidence_if_tag_exists(self, tag):
         """
         Returns the confidence level of a given tag if it exists in the tags list.
         Returns False if the tag is not present.
         """
-        if tag in self.tags:
-            index = self.tags.index(tag)
-            return self.tags_confidence[index]
-        return False
+        return self.tag_confidence_map.get(tag, False)
 
     # Calculate a single number to represent the overall confidence
     # of the documents metadata to be uses to sort and filter documents. 
@@ -654,24 +890,16 @@ class PDFDocument:
         # Create a mapping from original to new tags, ignoring empty replacements
         replacement_dict = {rep['original']: rep['replacement'] for rep in replacements}
 
-        # Structure to store the updated confidence and specificity for each tag
-        tag_info = {}
-
-        for i, tag in enumerate(self.tags):
+        # Build the new tag map in one pass
+        tag_confidence_map = {}
+        for tag, confidence in self.tag_confidence_map.items():
             # Determine the new tag, default to the original tag if no replacement is found
             new_tag = replacement_dict.get(tag, tag)
             if new_tag != "": 
-                # Access or default confidence and specificity values
-                confidence = self.tags_confidence[i] if i < len(self.tags_confidence) else 0
+                # Update with the latest value for confidence
+                tag_confidence_map[new_tag] = confidence
 
-                # Update with the latest values for confidence and specificity
-                tag_info[new_tag] = {
-                    'confidence': confidence
-                }
-
-        # Update the class attributes with the final lists
-        self.tags = list(tag_info.keys())
-        self.tags_confidence = [info['confidence'] for info in tag_info.values()]
+        self.tag_confidence_map = tag_confidence_map
         
     def get_short_description(self):
         return (
@@ -681,6 +909,10 @@ class PDFDocument:
         )
 
     def has_sufficient_information(self, threshold=7): 
+        # Title and creation date are the lower limit of the confidence index,
+        # if one of them is too low the average doesn't need to be calculated
+        if self.title_confidence < threshold or self.creation_date_confidence < threshold:
+            return False
         return self.get_confidence_index() >= threshold
     
     def get_creation_date_as_str(self):
@@ -690,42 +922,59 @@ class PDFDocument:
         self.analyze_document_images()
         return len(self.images)
 
-    def create_new_filename(self, format_str="%Y-%m-%d-{CREATOR}-{TITLE}.pdf"):
+    def create_new_filename(self, format_str=DEFAULT_FILENAME_FORMAT):
         """
         Creates a new filename based on a specified format.
         The format can include date formatting strings and {TITLE} as a placeholder for the document title.
         If no format is provided, the default format "YY-MM-DD-{TITLE}.pdf" is used.
         """
-        # Replace date parts in the format with the actual date
-        if self.creation_date:
-            date_str = self.creation_date.strftime(format_str)
+        # If no creation date is available, use the modification date
+        date = self.creation_date or self.modification_date
+
+        if format_str == DEFAULT_FILENAME_FORMAT:
+            # Common case, built directly without strftime
+            new_filename = f"{date.year:04d}-{date.month:02d}-{date.day:02d}-{self.creator}-{self.title}.pdf"
         else:
-            # If no creation date is available, use the modification date
-            date_str = self.modification_date.strftime(format_str)
+            # Replace date parts in the format with the actual date
+            date_str = date.strftime(format_str)
 
-        # Replace {TITLE} with the document title
-        new_filename = date_str.replace('{TITLE}', self.title)
-        new_filename = new_filename.replace('{CREATOR}', self.creator)
+            # Replace {TITLE} with the document title
+            new_filename = date_str.replace('{TITLE}', self.title)
+            new_filename = new_filename.replace('{CREATOR}', self.creator)
         # Store the new filename
         self.new_file_name = new_filename
         return self
 
+# Documents of the same producer often share their dates
+@functools.lru_cache(maxsize=1024)
 def pdf_date_to_datetime(pdf_date):
     """
     Converts a PDF date format to a Python datetime object.
     Example of a PDF date: "D:20150919085148Z00'00'"
     """
     # Remove the leading 'D:' and any apostrophes
-    date_str = re.sub(r'D:|\'+', '', pdf_date)
+    date_str = pdf_date[2:] if pdf_date.startswith("D:") else pdf_date
+    date_str = date_str.replace("'", "")
 
-    # Try to parse the date in the PDF format
+    # The date has fixed-width digits: YYYYMMDDHHmmSS, followed by the 
+    # timezone (Z for UTC or +HHmm / -HHmm), which is optional
     try:
-        # Assume the date is in UTC if no timezone is specified
-        if 'Z' in date_str:
-            date_str = date_str.replace('Z', '+0000')
-            return datetime.strptime(date_str, "%Y%m%d%H%M%S%z")
+        if len(date_str) < 14 or not date_str[:14].isdigit():
+            raise ValueError("invalid date")
+        tz_str = date_str[14:]
+        if not tz_str:
+            tzinfo = None
+        elif tz_str[0] == 'Z':
+            tzinfo = timezone.utc
+        elif tz_str[0] in '+-' and len(tz_str) >= 5 and tz_str[1:5].isdigit():
+            offset = timedelta(hours=int(tz_str[1:3]), minutes=int(tz_str[3:5]))
+            tzinfo = timezone(offset if tz_str[0] == '+' else -offset)
         else:
-            return datetime.strptime(date_str, "%Y%m%d%H%M%S")
+            raise ValueError("invalid timezone")
+        return datetime(
+            int(date_str[0:4]), int(date_str[4:6]), int(date_str[6:8]),
+            int(date_str[8:10]), int(date_str[10:12]), int(date_str[12:14]),
+            tzinfo=tzinfo)
     except ValueError:
-        print(f"Error parsing date: {pdf_date}")
-        return None
\ No newline at end of file
+        logging.error(f"Error parsing date: {pdf_date}")
+        return None
@@ -6,8 +6,74 @@ from datetime import datetime
 import pprint
 import traceback
 import csv
-
-from autoPDFtagger.PDFDocument import PDFDocument
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from autoPDFtagger.PDFDocument import PDFDocument, SAVED_ATTRIBUTES
+from autoPDFtagger import fastjson
+
+# Data types of the columns of an imported CSV-file, 
+# lists (tags) are stored as JSON strings
+CSV_COLUMN_TYPES = {
+    "folder_path_abs": str,
+    "relative_path": str,
+    "base_directory_abs": str,
+    "file_name": str,
+    "summary": str,
+    "summary_confidence": float,
+    "title": str,
+    "title_confidence": float,
+    "creation_date": str,
+    "creation_date_confidence": float,
+    "creator": str,
+    "creator_confidence": float,
+    "tags": str,
+    "tags_confidence": str,
+    "importance": float,
+    "importance_confidence": float
+}
+CSV_JSON_COLUMNS = frozenset(("tags", "tags_confidence"))
+
+# Leading "../" and a single "." are removed from relative paths when exporting
+RELATIVE_PATH_STRIP_REGEX = re.compile(r'^(\.\./)+|^\.$')
+
+# Yields the directory entries (os.DirEntry) of all files in a folder 
+# and its subfolders. os.scandir gets the file type with the names, 
+# so no extra stat() call is needed for walking the tree
+def scan_files(folder):
+    folders = [folder]
+    while folders:
+        with os.scandir(folders.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+                elif entry.is_file():
+                    yield entry
+
+# PyMuPDF can't be used in several threads at once, so work on 
+# the PDF-files of many documents is spread over processes. 
+# The functions run in the processes need to be module-level and 
+# only get what they need (paths and metadata), not the documents
+# with their cached text and images.
+# Processes are started fresh ("spawn") instead of forking this 
+# process, which may already run HTTP-connections and threads.
+def map_in_processes(function, *iterables):
+    arguments = [list(iterable) for iterable in iterables]
+    if len(arguments[0]) < 2:
+        return list(map(function, *arguments))
+    with ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn")) as executor:
+        return list(executor.map(function, *arguments, chunksize=8))
+
+def create_thumbnail(file_path, base_directory, thumbnail_filename):
+    with PDFDocument(file_path, base_directory) as pdf_document:
+        pdf_document.create_thumbnail(thumbnail_filename)
+
+# metadata: the attributes written by save_to_file (SAVED_ATTRIBUTES), 
+# copied as they are, so that e.g. the time of creation_date is kept
+def save_document(file_path, base_directory, metadata, target_file_path):
+    with PDFDocument(file_path, base_directory) as pdf_document:
+        vars(pdf_document).update(metadata)
+        pdf_document.save_to_file(target_file_path)
 
 class PDFList:
     def __init__(self, folder=""):
@@ -21,7 +87,7 @@ class PDFList:
             # If document already exists, data will be updated corresponding
             # to confidence-data (more actual data will be preserved)
             logging.info(f"File {abs_path} already in database. Updating meta data.")
-            self.pdf_documents[abs_path].set_from_dict(pdf_document.to_dict())
+            self.pdf_documents[abs_path].merge_from(pdf_document)
         else:
             self.pdf_documents[abs_path] = pdf_document
             logging.info(f"File added: {pdf_document.file_name}")
@@ -31,16 +97,30 @@ class PDFList:
         for pdf_doc_dict in pdf_list:
             pdf_doc_dict.pop("ocr_text", None)
 
-        return json.dumps(pdf_list, indent=4)
+        return fastjson.dumps(pdf_list, indent=True)
 
+    # Each document gets its own thumbnail in thumbnail_folder, at its 
+    # relative path with the file name ending in .png
     def create_thumbnail_for_documents(self, thumbnail_folder):
-        for pdf_document in self.pdf_documents.values():
-            pdf_document.create_thumbnail(thumbnail_folder)
+        documents = list(self.pdf_documents.values())
+        thumbnail_filenames = []
+        for pdf_document in documents:
+            relative_path = RELATIVE_PATH_STRIP_REGEX.sub('', pdf_document.relative_path)
+            target_directory = os.path.join(thumbnail_folder, relative_path)
+            os.makedirs(target_directory, exist_ok=True)
+            thumbnail_filenames.append(os.path.join(
+                target_directory, os.path.splitext(pdf_document.file_name)[0] + ".png"))
+        map_in_processes(
+            create_thumbnail, 
+            [pdf_document.get_absolute_path() for pdf_document in documents],
+            [pdf_document.base_directory_abs for pdf_document in documents],
+            thumbnail_filenames)
 
     # Add single file (pdf, csv, json)
-    def add_file(self, file_path, base_dir):
+    # stat_result: os.stat_result of the file if already known
+    def add_file(self, file_path, base_dir, stat_result=None):
         if file_path.endswith(".pdf"):
-            pdf_document = PDFDocument(file_path, base_dir)
+            pdf_document = PDFDocument(file_path, base_dir, stat_result)
             self.add_pdf_document(pdf_document)
         elif file_path.endswith(".json"):
             self.import_from_json_file(file_path)
@@ -58,10 +138,13 @@ class PDFList:
         if os.path.isdir(folder_or_file):
             # Folder? 
             logging.info("Scanning folder " +folder_or_file )
-            for root, _, files in os.walk(folder_or_file):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    self.add_file(file_path, base_dir)
+            for entry in scan_files(folder_or_file):
+                # PDF-files get their stat result from the directory 
+                # entry, so they don't need to be checked again
+                if entry.name.endswith(".pdf"):
+                    self.add_file(entry.path, base_dir, entry.stat())
+                else:
+                    self.add_file(entry.path, base_dir)
                     
         else: # existing file, no directory
             self.add_file(folder_or_file, base_dir)
@@ -92,8 +175,16 @@ class PDFList:
 
 
     def export_to_json_file(self, filename):
+        # Documents are written one by one, so the whole 
+        # database never needs to be held as a list of dicts
         with open(filename, 'w', encoding='utf-8') as f:
-            json.dump([doc.to_dict() for doc in self.pdf_documents.values()], f, indent=4)
+            f.write('[')
+            separator = '\n'
+            for doc in self.pdf_documents.values():
+                f.write(separator)
+                f.write(fastjson.dumps(doc.to_dict(), indent=True))
+                separator = ',\n'
+            f.write('\n]\n')
     
     def export_to_csv_file(self, filename):
         try:
@@ -101,25 +192,22 @@ class PDFList:
                 logging.warning("No documents to export.")
                 return
 
-            first_document = next(iter(self.pdf_documents.values()))
-            fieldnames = list(first_document.to_dict().keys())
+            first_dict = next(iter(self.pdf_documents.values())).to_dict()
+            fieldnames = list(first_dict.keys())
+            # Columns containing lists (tags) are stored as JSON strings
+            list_columns = {key for key, value in first_dict.items() if isinstance(value, list)}
 
             with open(filename, 'w', newline='', encoding='utf-8-sig') as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames, delimiter=';')
-                writer.writeheader()
+                writer = csv.writer(csvfile, delimiter=';')
+                writer.writerow(fieldnames)
 
                 for pdf_document in self.pdf_documents.values():
-                    # Convert the document to a dictionary
+                    # Convert the document to a row in the order of the fieldnames
                     pdf_dict = pdf_document.to_dict()
-
-                    # Convert lists to JSON strings
-                    for key, value in pdf_dict.items():
-                        if isinstance(value, list):
-                            pdf_dict[key] = json.dumps(value)
-                        else:
-                            pdf_dict[key] = str(value)
-
-                    writer.writerow(pdf_dict)
+                    writer.writerow([
+                        json.dumps(pdf_dict[key]) if key in list_columns else str(pdf_dict[key])
+                        for key in fieldnames
+                    ])
 
             logging.info(f"Database exported to CSV: {filename}")
         except Exception as e:
@@ -127,27 +215,8 @@ class PDFList:
 
 
     def clean_csv_row(self, row):
-        data_types = {
-            "folder_path_abs": str,
-            "relative_path": str,
-            "base_directory_abs": str,
-            "file_name": str,
-            "summary": str,
-            "summary_confidence": float,
-            "title": str,
-            "title_confidence": float,
-            "creation_date": str,
-            "creation_date_confidence": float,
-            "creator": str,
-            "creator_confidence": float,
-            "tags": str,
-            "tags_confidence": str,
-            "importance": float,
-            "importance_confidence": float
-        }
-        
         for key, value in row.items():
-            if key in ['tags', 'tags_confidence'] and value.startswith('[') and value.endswith(']'):
+            if key in CSV_JSON_COLUMNS and value[:1] == '[' and value[-1:] == ']':
                 try:
                     # Convert JSON string back to list
                     row[key] = json.loads(value)
@@ -156,7 +225,7 @@ class PDFList:
             else:
                 try:
                     # Convert to appropriate data type
-                    row[key] = data_types[key](value)
+                    row[key] = CSV_COLUMN_TYPES[key](value)
                 except ValueError:
                     raise ValueError(f"Value conversion error for {key}: {value}")
 
@@ -185,8 +254,9 @@ class PDFList:
         except Exception as e:
             logging.error(f"Importing from CSV-File failed: {e}\n" + traceback.format_exc())
 
+    # json_text may also be bytes (UTF-8), as read from a file
     def import_from_json(self, json_text):
-        data = json.loads(json_text) 
+        data = fastjson.loads(json_text)
         for d in data:
             try:
                 pdf_document = self.create_PDFDocument_from_dict(d)
@@ -198,7 +268,8 @@ class PDFList:
 
     def import_from_json_file(self, filename):
         try:
-            with open(filename, 'r', encoding='utf-8') as f:
+            # Read as bytes, the JSON parser decodes UTF-8 itself
+            with open(filename, 'rb') as f:
                 logging.info(f"Adding files from JSON-file: {filename}")
                 self.import_from_json(f.read())
                 logging.info("JSON-file processing completed")
@@ -221,8 +292,8 @@ class PDFList:
         
     def update_from_json(self, filename):
         try:
-            with open(filename, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            with open(filename, 'rb') as f:
+                data = fastjson.loads(f.read())
 
             for doc_data in data:
                 abs_path = doc_data['absolute_path']
@@ -240,18 +311,29 @@ class PDFList:
 
     def export_to_folder(self, path):
         logging.info("Exporting files to folder " + path)
+        file_paths = []
+        base_directories = []
+        metadata = []
+        target_file_paths = []
         for pdf in self.pdf_documents.values():
             # Determine the new relative path and create the folder if it doesn't exist
-            new_relative_path = pdf.new_relative_path if hasattr(pdf, 'new_relative_path') else re.sub(r'^(\.\./)+|^\.$', '', pdf.relative_path)
+            new_relative_path = getattr(pdf, 'new_relative_path', None)
+            if new_relative_path is None:
+                new_relative_path = RELATIVE_PATH_STRIP_REGEX.sub('', pdf.relative_path)
             target_directory = os.path.join(path, new_relative_path)
             os.makedirs(target_directory, exist_ok=True)
 
             # Determine the filename for the target
-            target_filename = pdf.new_file_name if hasattr(pdf, 'new_file_name') else pdf.file_name
+            target_filename = getattr(pdf, 'new_file_name', None) or pdf.file_name
             target_file_path = os.path.join(target_directory, target_filename)
-            print(pdf.new_file_name)
-            # Copy the file to the target folder
-            pdf.save_to_file(target_file_path)
+            logging.info(f"Exporting {target_filename}")
+            file_paths.append(pdf.get_absolute_path())
+            base_directories.append(pdf.base_directory_abs)
+            metadata.append({name: getattr(pdf, name) for name in SAVED_ATTRIBUTES})
+            target_file_paths.append(target_file_path)
+
+        # Copy the files to the target folder
+        map_in_processes(save_document, file_paths, base_directories, metadata, target_file_paths)
 
     def create_new_filenames(self):
         for doc in self.pdf_documents.values(): 
@@ -21,16 +21,28 @@ class autoPDFtagger:
         # Read folder oder PDF-file
         self.file_list.add_pdf_documents_from_folder(path, base_dir)
 
-    def file_analysis(self):
+    def file_analysis(self, include_metadata=True):
         for document in self.file_list.pdf_documents.values():
             logging.info(f"... {document.file_name}")
-            document.analyze_file()
+            with document:
+                document.analyze_file(include_metadata)
 
-    def ai_text_analysis(self):
+    def ai_text_analysis(self, batch_size=5):
         logging.info("Asking AI to analyze PDF-Text")
         cost = 0 # for monitoring
 
+        # Documents with short texts are collected and analyzed 
+        # in batches of several documents per API-request
+        batch_ai = AIAgents_OpenAI_pdf.AIAgent_OpenAI_pdf_text_analysis()
+        batch_ai.log_file = "api.log"
+        short_documents = []
+
         for document in self.file_list.pdf_documents.values():
+            with document:
+                short_text = batch_ai.is_short_text(document)
+            if short_text:
+                short_documents.append(document)
+                continue
             
             ai = AIAgents_OpenAI_pdf.AIAgent_OpenAI_pdf_text_analysis()
             ai.log_file = "api.log"
@@ -43,6 +55,21 @@ class autoPDFtagger:
                 logging.error(document.file_name)
                 logging.error(f"Text analysis failed. Error message: {e}")
                 logging.error(traceback.format_exception())
+
+        for i in range(0, len(short_documents), batch_size):
+            batch = short_documents[i:i + batch_size]
+            logging.info("... " + ", ".join(document.file_name for document in batch))
+            try:
+                responses = batch_ai.analyze_text_batch(batch)
+            except Exception as e:
+                logging.error(f"Text analysis failed. Error message: {e}")
+                logging.info("Analyzing the documents of the failed batch separately")
+                responses = batch_ai.analyze_text_separately(batch)
+            for document, response in zip(batch, responses):
+                # Failed analyses (None) are already logged
+                if response is not None:
+                    document.set_from_json(response)
+        cost += batch_ai.cost
         logging.info(f"Spent {cost:.4f} $ for text analysis")
 
 
@@ -53,7 +80,8 @@ class autoPDFtagger:
         for document in self.file_list.pdf_documents.values(): 
             ai = AIAgents_OpenAI_pdf.AIAgent_OpenAI_pdf_image_analysis()
             logging.info("... " + document.file_name)
-            response = ai.analyze_images(document)
+            with document:
+                response = ai.analyze_images(document)
             document.set_from_json(response)
             costs += ai.cost
         logging.info("Spent " + str(costs) + " $ for image analysis")
@@ -101,9 +129,15 @@ class autoPDFtagger:
     def get_stats(self):
 
         total_documents = len(self.file_list.pdf_documents)
-        total_pages = sum([len(doc.pages) for doc in self.file_list.pdf_documents.values()])
-        total_images = sum([doc.get_image_number() for doc in self.file_list.pdf_documents.values()])
-        total_text_tokens = sum([len(doc.get_pdf_text().split()) // 3 for doc in self.file_list.pdf_documents.values()])
+        total_pages = 0
+        total_images = 0
+        total_text_tokens = 0
+        for doc in self.file_list.pdf_documents.values():
+            # Pages and images are analyzed on first access
+            with doc:
+                total_pages += len(doc.pages)
+                total_images += doc.get_image_number()
+                total_text_tokens += len(doc.get_pdf_text().split()) // 3
 
         # A very rough estimate for expected costs to do analysis over the actual data
         estimated_text_analysis_cost_lower = ((total_text_tokens + total_documents * 1000) / 1000) * 0.001
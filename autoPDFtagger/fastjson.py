@@ -0,0 +1,20 @@
+# JSON-functions using orjson if it is installed (several times
+# faster for large answers and databases), otherwise falling back 
+# to the json module of the standard library.
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def loads(text):
+    if orjson:
+        return orjson.loads(text)
+    return json.loads(text)
+
+# Non-ASCII characters are written as they are (like orjson does)
+def dumps(obj, indent=False):
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0).decode()
+    return json.dumps(obj, indent=2 if indent else None, ensure_ascii=False)
@@ -16,6 +16,7 @@ def main():
     parser.add_argument("-s", "--csv", nargs="?", const=None, help="Output CSV-Database to specified file")
     parser.add_argument("-d", "--debug", help="Debug level (0: no debug, 1: basic debug, 2: detailed debug)", type=int, choices=[0, 1, 2], default=1)
     parser.add_argument("-f", "--file-analysis", help="Try to conventionally extract metadata from file, file name and folder structure", action="store_true")   
+    parser.add_argument("--skip-metadata", help="Only use file name and folder structure in file analysis, without reading the PDF metadata", action="store_true")
     parser.add_argument("-t", "--ai-text-analysis", help="Do an AI text analysis", action="store_true")     
     parser.add_argument("-i", "--ai-image-analysis", help="Do an AI image analysis", action="store_true")
     parser.add_argument("-c", "--ai-tag-analysis", help="Do an AI tag analysis", action="store_true")
@@ -78,7 +79,7 @@ def main():
 
     if args.file_analysis:
         logging.info("Doing basic file-analysis")
-        archive.file_analysis()
+        archive.file_analysis(include_metadata=not args.skip_metadata)
 
     def is_output_option_set():
         return args.export is not None or hasattr(args, "json") or args.csv is not None
@@ -11,10 +11,12 @@ setup(
     install_requires=[
         "PyMuPDF==1.23.6",
         "openai==1.3.7",
-        "pytz==2022.7",
-        "tenacity==8.2.3",
+        "httpx",
         "tiktoken==0.3.3"
     ],
+    extras_require={
+        "fast": ["orjson", "pybase64"]
+    },
     entry_points={
         'console_scripts': [
             'autoPDFtagger = autoPDFtagger.main:main',
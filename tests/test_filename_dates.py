@@ -0,0 +1,36 @@
+import os
+import tempfile
+import unittest
+
+from autoPDFtagger.PDFDocument import PDFDocument
+
+
+class TestDateFromFilename(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+
+    def date_from_filename(self, file_name):
+        path = os.path.join(self.folder.name, file_name)
+        open(path, "wb").close()
+        document = PDFDocument(path, self.folder.name)
+        document.extract_date_from_filename()
+        return document.get_creation_date_as_str()
+
+    def test_single_date(self):
+        self.assertEqual(self.date_from_filename("invoice 2021_03_04.pdf"), "2021-03-04")
+
+    def test_no_date(self):
+        self.assertIsNone(self.date_from_filename("invoice.pdf"))
+
+    def test_format_priority(self):
+        # Dates of earlier formats win, regardless of their position
+        self.assertEqual(self.date_from_filename("01-Feb-2020 2021-03-04.pdf"), "2021-03-04")
+        self.assertEqual(self.date_from_filename("report 15 Jan 2023 v20220101.pdf"), "2022-01-01")
+
+    def test_invalid_date_skipped(self):
+        self.assertEqual(self.date_from_filename("2023-13-45 05 Mar 2022.pdf"), "2022-03-05")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from autoPDFtagger.PDFDocument import PDFDocument, pdf_date_to_datetime, PDF_CREATION_DATE_CONFIDENCE
+
+try:
+    import fitz
+except ImportError:
+    fitz = None
+
+
+class TestPDFDateToDatetime(unittest.TestCase):
+    def test_utc(self):
+        self.assertEqual(
+            pdf_date_to_datetime("D:20150919085148Z00'00'"),
+            datetime(2015, 9, 19, 8, 51, 48, tzinfo=timezone.utc))
+
+    def test_offset(self):
+        self.assertEqual(
+            pdf_date_to_datetime("D:20150919085148+02'00'"),
+            datetime(2015, 9, 19, 8, 51, 48, tzinfo=timezone(timedelta(hours=2))))
+
+    def test_without_timezone(self):
+        self.assertEqual(
+            pdf_date_to_datetime("D:20150919085148"),
+            datetime(2015, 9, 19, 8, 51, 48))
+
+    def test_invalid(self):
+        self.assertIsNone(pdf_date_to_datetime("D:2015"))
+
+
+@unittest.skipIf(fitz is None, "PyMuPDF not installed")
+class TestMetadataCreationDate(unittest.TestCase):
+    def test_creation_date_from_metadata(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "document.pdf")
+            pdf = fitz.open()
+            pdf.new_page()
+            pdf.set_metadata({"creationDate": "D:20150919085148+02'00'"})
+            pdf.save(path)
+            pdf.close()
+
+            with PDFDocument(path, folder) as document:
+                document.analyze_file()
+
+            # Converted to local time, without timezone
+            expected = datetime(2015, 9, 19, 8, 51, 48, tzinfo=timezone(timedelta(hours=2)))
+            self.assertEqual(document.creation_date, expected.astimezone().replace(tzinfo=None))
+            self.assertEqual(document.creation_date_confidence, PDF_CREATION_DATE_CONFIDENCE)
+
+    def test_creation_date_loses_to_filename(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "2021-03-04 letter.pdf")
+            pdf = fitz.open()
+            pdf.new_page()
+            pdf.set_metadata({"creationDate": "D:20150919085148+02'00'"})
+            pdf.save(path)
+            pdf.close()
+
+            with PDFDocument(path, folder) as document:
+                document.analyze_file()
+
+            self.assertEqual(document.get_creation_date_as_str(), "2021-03-04")
+
+
+if __name__ == "__main__":
+    unittest.main()